@@ -1,23 +1,41 @@
 #!/usr/bin/env python3
 """Main module"""
 
+import functools
 import os
+import signal
 
+import tornado.httpserver
 import tornado.ioloop
+import tornado.netutil
+import tornado.process
 from tornado.options import define, options, parse_command_line
 from tornado.web import RequestHandler
 
 import netplay_index.api as api
+import netplay_index.feed as feed
 import netplay_index.login as login
 import netplay_index.database as database
 import netplay_index.util as util
 import netplay_index.admin as admin
 import netplay_index.metrics as metrics
+import netplay_index.replica as replica
+import netplay_index.settings as settings
+import netplay_index.snapshot as snapshot
 
 define("bind_address", default="127.0.0.1", help="Address to listen on", type=str)
 define("port", default=8000, help="Port to listen on", type=int)
 define("add_sysop", default=None, help="Add a new sysop via the command line")
 define("reset_pw", default=None, help="Reset the password of a given user")
+define(
+    "workers",
+    default=1,
+    help="Number of processes to serve from, 0 for one per CPU",
+    type=int,
+)
+
+# Generated before forking so every worker accepts the same cookies
+COOKIE_SECRET = os.urandom(32)
 
 # pylint: disable=W0223
 class MainHandler(RequestHandler):
@@ -28,16 +46,28 @@ class MainHandler(RequestHandler):
         self.redirect("https://dolphin-emu.org")
 
 
-def make_app():
-    """Return new app"""
+def make_app(owner=None):
+    """Return new app
+
+    Given the URL of the process owning the sessions, the app serves lists
+    from a replica and forwards all other requests to the owner."""
 
     if not database.initialize():
         return None
 
-    return tornado.web.Application(
-        [
+    if owner is not None:
+        handlers = [
+            (r"/v(?P<api_version>\d+)/feed", feed.Handler),
+            (r"/v(?P<api_version>\d+)/(?P<action>list)", api.Handler),
+            # Only for replicas, on the owner's loopback socket
+            (r"/replicate", tornado.web.ErrorHandler, {"status_code": 404}),
+            (r"/.*", replica.ProxyHandler, {"owner": owner}),
+        ]
+    else:
+        handlers = [
             (r"/", MainHandler),
             (r"/metrics", metrics.MetricsHandler),
+            (r"/v(?P<api_version>\d+)/feed", feed.Handler),
             (r"/v(?P<api_version>\d+)/(?P<action>[\w/]+)", api.Handler),
             (r"/login", login.login.Login),
             (r"/logout", login.login.Logout),
@@ -46,34 +76,132 @@ def make_app():
             (r"/admin/bans", admin.bans.Handler),
             (r"/admin/user_management", admin.user_management.Handler),
             (r"/admin/server_list", admin.server_list.Handler),
-        ],
-        cookie_secret=os.urandom(32),
+            (r"/admin/profiler", admin.profiler.Handler),
+        ]
+
+    return tornado.web.Application(
+        handlers,
+        cookie_secret=COOKIE_SECRET,
         xsrf_cookies=True,
         static_path=os.path.join(os.path.dirname(__file__), "static"),
     )
 
 
+def make_owner_app(app):
+    """Return app, with what replicas poll for changes added
+
+    For the loopback socket of the process owning the sessions, which replicas
+    also forward requests to."""
+    return tornado.web.Application(
+        [(r"/replicate", replica.ReplicateHandler), (r".*", app)],
+        log_function=replica.log_request,
+    )
+
+
+def _shutdown(owner):
+    """Save sessions before exiting, unless they are a replica"""
+    try:
+        if owner is None and settings.SESSION_SNAPSHOT_PATH:
+            snapshot.save()
+    finally:
+        tornado.ioloop.IOLoop.current().stop()
+
+
+def _on_signal(owner, signum, frame):
+    # pylint: disable=W0613
+    tornado.ioloop.IOLoop.current().add_callback_from_signal(_shutdown, owner)
+
+
+def _forward_signal(signum, frame):
+    """Pass a signal to the parent of the workers on to them
+
+    They exit normally on it, so fork_processes doesn't restart them and exits
+    once they are all gone."""
+    # pylint: disable=W0613
+    signal.signal(signum, signal.SIG_IGN)
+    os.killpg(0, signum)
+
+
 def main():
     parse_command_line()
 
-    APP = make_app()
+    if options.add_sysop is not None or options.reset_pw is not None:
+        if not database.initialize():
+            exit(1)
+
+        if options.add_sysop is not None:
+            RANDOM_PW = util.generate_secret()
+            database.add_login(options.add_sysop, RANDOM_PW, True)
+            print("Password for {}: {}".format(options.add_sysop, RANDOM_PW))
+        else:
+            RANDOM_PW = util.generate_secret()
+            database.update_login(options.reset_pw, RANDOM_PW)
+            print("New password for {}: {}".format(options.reset_pw, RANDOM_PW))
+
+        exit(0)
+
+    sockets = tornado.netutil.bind_sockets(options.port, options.bind_address)
+    owner_sockets = []
+    owner = None
+
+    if options.workers != 1:
+        if not metrics.MULTIPROCESS_DIRECTORY:
+            print("Set PROMETHEUS_MULTIPROC_DIR to include all workers in /metrics.")
+        metrics.clear_multiprocess_directory()
+
+        # Create or upgrade the database once, before the workers open it
+        if not database.initialize():
+            exit(1)
+        database.close()
+
+        # Lists are rate limited by whichever worker gets them, the other
+        # actions by the owner
+        workers = options.workers or tornado.process.cpu_count()
+        rate, burst = settings.RATE_LIMITS["list"]
+        settings.RATE_LIMITS["list"] = (rate / workers, max(1, burst / workers))
+
+        # Replicas reach the owner of the sessions (task 0) on this socket
+        owner_sockets = tornado.netutil.bind_sockets(0, "127.0.0.1")
+
+        # Stopping the parent stops the workers, instead of orphaning them
+        signal.signal(signal.SIGTERM, _forward_signal)
+        signal.signal(signal.SIGINT, _forward_signal)
+
+        if tornado.process.fork_processes(options.workers) != 0:
+            owner = "http://127.0.0.1:{}".format(owner_sockets[0].getsockname()[1])
+            for owner_socket in owner_sockets:
+                owner_socket.close()
+            owner_sockets = []
+
+        # A restarted worker drops the live gauges of the one it replaces
+        metrics.mark_dead_processes()
+
+    signal.signal(signal.SIGTERM, functools.partial(_on_signal, owner))
+    signal.signal(signal.SIGINT, functools.partial(_on_signal, owner))
+
+    APP = make_app(owner)
 
     if APP is None:
         exit(1)
 
-    if options.add_sysop is not None:
-        RANDOM_PW = util.generate_secret()
-        database.add_login(options.add_sysop, RANDOM_PW, True)
-        print("Password for {}: {}".format(options.add_sysop, RANDOM_PW))
-        exit(0)
+    if owner is None and settings.SESSION_SNAPSHOT_PATH:
+        print("Restored {} sessions.".format(snapshot.load()))
 
-    if options.reset_pw is not None:
-        RANDOM_PW = util.generate_secret()
-        database.update_login(options.reset_pw, RANDOM_PW)
-        print("New password for {}: {}".format(options.reset_pw, RANDOM_PW))
-        exit(0)
+    server = tornado.httpserver.HTTPServer(APP)
+    server.add_sockets(sockets)
+
+    if owner_sockets:
+        owner_server = tornado.httpserver.HTTPServer(make_owner_app(APP))
+        owner_server.add_sockets(owner_sockets)
+
+    if owner is None:
+        api.start_session_cleanup()
+
+        if settings.SESSION_SNAPSHOT_PATH:
+            snapshot.start_snapshots()
+    else:
+        replica.start_replication(owner)
 
-    APP.listen(options.port, options.bind_address)
     print("Listening on {}:{}...".format(options.bind_address, options.port))
     tornado.ioloop.IOLoop.current().start()
 
@@ -5,5 +5,6 @@ import netplay_index.admin.server_list as server_list
 import netplay_index.admin.overview as overview
 import netplay_index.admin.bans as bans
 import netplay_index.admin.blacklist as blacklist
+import netplay_index.admin.profiler as profiler
 
 name = "admin"
@@ -15,7 +15,7 @@ class Handler(AdminHandler):
         """Additional parameters needed by the template"""
         return {"banned_hosts": database.bans_get()}
 
-    def admin_post(self):
+    async def admin_post(self):
         """Handle actions"""
         action = self.get_argument("action", default=None)
         host = self.get_argument("host", default=None)
@@ -40,8 +40,8 @@ class Handler(AdminHandler):
                 self.set_error("Host is already banned")
                 return
 
-            database.ban_add(host, user, reason)
+            await database.ban_add_async(host, user, reason)
             return
 
         if action == "ban_remove":
-            database.ban_remove(host)
+            await database.ban_remove_async(host)
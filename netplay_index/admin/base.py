@@ -37,12 +37,13 @@ class AdminHandler(RequestHandler):
         """Render an admin template"""
 
         ajax = self.get_argument("ajax", default=False)
+        username = self.get_username()
 
         template_args = {
-            "username": self.get_username(),
+            "username": username,
             "view": self.view(),
             "error": self.error,
-            "sysop": database.is_sysop(self.get_username()),
+            "sysop": database.get_permissions(username).sysop,
             "ajax": ajax,
         }
 
@@ -53,14 +54,18 @@ class AdminHandler(RequestHandler):
 
         self.render("{}.html".format(self.view()), **template_args)
 
-    def post(self):
+    async def post(self):
         """Handle POST and forward it to child classes"""
         self.set_error("")
         if not self.get_username():
             self.redirect("/login?view=" + self.view())
             return
 
-        self.admin_post()
+        # Views may need to wait for slow work, e.g. hashing passwords or
+        # writing to the database
+        result = self.admin_post()
+        if result is not None:
+            await result
 
         self.admin_render()
 
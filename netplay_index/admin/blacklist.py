@@ -15,7 +15,7 @@ class Handler(AdminHandler):
         """Additional parameters needed by the template"""
         return {"blacklist": database.blacklist_get()}
 
-    def admin_post(self):
+    async def admin_post(self):
         """Handle actions"""
 
         action = self.get_argument("action", default=None)
@@ -41,8 +41,8 @@ class Handler(AdminHandler):
                 self.set_error("Word is already blacklisted")
                 return
 
-            database.blacklist_add(word, user, reason)
+            await database.blacklist_add_async(word, user, reason)
             return
 
         if action == "blacklist_remove":
-            database.blacklist_remove(word)
+            await database.blacklist_remove_async(word)
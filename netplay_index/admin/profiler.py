@@ -0,0 +1,65 @@
+"""Profiler"""
+
+from netplay_index.admin.base import AdminHandler
+import netplay_index.database as database
+import netplay_index.profiler as profiler
+import netplay_index.settings as settings
+
+# pylint: disable=W0223
+class Handler(AdminHandler):
+    """Start profiles and show their results"""
+
+    def view(self):
+        """Set view to use"""
+        return "profiler"
+
+    def template_args(self):
+        """Additional template arguments"""
+        return {
+            "profile": profiler.PROFILE,
+            "max_duration": settings.PROFILER_MAX_DURATION,
+        }
+
+    def get(self):
+        """Send the stacks of the last profile for flamegraphs if asked to"""
+        if self.get_argument("format", default=None) != "collapsed":
+            super().get()
+            return
+
+        profile = profiler.PROFILE
+
+        if not database.is_sysop(self.get_username()):
+            self.set_status(403)
+            return
+
+        if profile is None or profile.finished is None:
+            self.set_status(404)
+            return
+
+        self.set_header("Content-Type", "text/plain; charset=UTF-8")
+        self.set_header(
+            "Content-Disposition", 'attachment; filename="netplay-index.folded"'
+        )
+        self.write(profile.collapsed())
+
+    def admin_post(self):
+        """Handle actions"""
+
+        if not database.is_sysop(self.get_username()):
+            self.set_error("Only sysop can profile")
+            return
+
+        try:
+            duration = float(self.get_argument("duration", default=""))
+        except ValueError:
+            self.set_error("Missing parameters")
+            return
+
+        if not 0 < duration <= settings.PROFILER_MAX_DURATION:
+            self.set_error(
+                "Profiles take up to {} seconds".format(settings.PROFILER_MAX_DURATION)
+            )
+            return
+
+        if not profiler.start(duration):
+            self.set_error("Already profiling")
@@ -15,7 +15,7 @@ class Handler(AdminHandler):
         """Additional template arguments"""
         return {"users": database.get_users()}
 
-    def change_user_password(self, username, password):
+    async def change_user_password(self, username, password):
         """Change username's password"""
         if not username or not password:
             self.set_error("Missing parameters")
@@ -35,9 +35,9 @@ class Handler(AdminHandler):
             self.set_error("Password cannot be empty!")
             return
 
-        database.update_login(username, password)
+        await database.update_login_async(username, password)
 
-    def remove_user(self, username):
+    async def remove_user(self, username):
         """Remove user"""
 
         if not username:
@@ -56,9 +56,11 @@ class Handler(AdminHandler):
             self.set_error("Can't delete own account!")
             return
 
-        database.delete_login(username)
+        await database.delete_login_async(username)
 
-    def create_user(self, username, password, sysop, can_ban, can_modify_blacklist):
+    async def create_user(
+        self, username, password, sysop, can_ban, can_modify_blacklist
+    ):
         if not username and not password:
             self.set_error("Missing parameters")
             return
@@ -75,9 +77,11 @@ class Handler(AdminHandler):
             self.set_error("Password cannot be empty!")
             return
 
-        database.add_login(username, password, sysop, can_ban, can_modify_blacklist)
+        await database.add_login_async(
+            username, password, sysop, can_ban, can_modify_blacklist
+        )
 
-    def admin_post(self):
+    async def admin_post(self):
         """Handle actions"""
 
         action = self.get_argument("action", default=None)
@@ -86,11 +90,11 @@ class Handler(AdminHandler):
         if action == "change_password":
             password = self.get_argument("password", default=None)
 
-            self.change_user_password(affected_username, password)
+            await self.change_user_password(affected_username, password)
             return
 
         if action == "delete_user":
-            self.remove_user(affected_username)
+            await self.remove_user(affected_username)
             return
 
         if action == "create_user":
@@ -101,6 +105,6 @@ class Handler(AdminHandler):
                 "can_modify_blacklist", default=False
             )
 
-            self.create_user(
+            await self.create_user(
                 affected_username, password, sysop, can_ban, can_modify_blacklist
             )
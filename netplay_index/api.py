@@ -1,51 +1,152 @@
 """Handle API requests"""
 
-import re
+import base64
+import binascii
+import hashlib
+import math
 import time
 
+from tornado.escape import json_decode, json_encode, utf8
+from tornado.ioloop import PeriodicCallback
 from tornado.web import RequestHandler
 
-from netplay_index.util import check_origin, generate_secret, get_ip
+from netplay_index.util import (
+    LRUCache,
+    TokenBuckets,
+    check_origin,
+    generate_secret,
+    get_ip,
+    get_rate_limit_key,
+)
 import netplay_index
 import netplay_index.database as database
 import netplay_index.settings as settings
 import netplay_index.sessions as sessions
 import netplay_index.metrics as metrics
 
-LAST_SESSION_CLEANUP = 0
+# Encoded /list responses, their ETags and session counts, by session
+# generation and filters
+LIST_CACHE = LRUCache(settings.LIST_CACHE_SIZE)
 
+# Request budgets, by IP and action
+RATE_LIMITER = TokenBuckets(settings.RATE_LIMIT_MAX_ENTRIES)
 
+
+@metrics.SESSION_CLEANUP_DURATION.time()
 def _cleanup_sessions():
-    to_delete = []
-    for key in sessions.get_all():
-        if (
-            time.time() - sessions.get_entry(key)["timestamp"]
-            > settings.SESSION_TIMEOUT_SECONDS
-        ):
-            to_delete.append(key)
+    sessions.remove_expired(time.time() - settings.SESSION_TIMEOUT_SECONDS)
 
-    for key in to_delete:
-        sessions.remove_entry(key)
 
+def start_session_cleanup():
+    """Periodically remove timed-out sessions from the index"""
+    callback = PeriodicCallback(
+        _cleanup_sessions, settings.SESSION_CLEANUP_DELAY * 1000
+    )
+    callback.start()
 
-def _filter_string(sessions, key, value, match=False):
-    filtered_sessions = []
+    return callback
+
+
+def _keep_alive(secret, timestamp, game, in_game, player_count):
+    """Refresh a session and apply updates, returning the resulting status"""
+    if sessions.get_entry(secret) is None:
+        return "BAD_SESSION"
+
+    sessions.update_entry(secret, timestamp=timestamp)
+
+    updates = {}
+
+    if game is not None:
+        if database.is_string_blacklisted(game):
+            return "BLACKLISTED_WORD"
+        updates["game"] = game
+
+    try:
+        if in_game is not None:
+            updates["in_game"] = bool(int(in_game))
+        if player_count is not None:
+            updates["player_count"] = int(player_count)
+    except (TypeError, ValueError):
+        return "PARSE_ERROR"
+
+    sessions.update_entry(secret, **updates)
+
+    return "OK"
+
+
+def get_filters(handler):
+    """Get the exact-match filters and substring searches of a list request
+
+    Raises ValueError if they can't be parsed."""
+    filters = {}
+    search = {}
+
+    for field in ["region", "version"]:
+        value = handler.get_argument(field, default=None)
+        if value is not None:
+            filters[field] = value
+
+    for field in ["password", "in_game"]:
+        value = handler.get_argument(field, default=None)
+        if value is not None:
+            filters[field] = bool(int(value))
+
+    for field in ["name", "game"]:
+        value = handler.get_argument(field, default=None)
+        if value is not None:
+            search[field] = value
+
+    return filters, search
 
-    for session in sessions:
-        if match:
-            if re.search(re.escape(value), str(session[key]), re.IGNORECASE):
-                filtered_sessions.append(session)
-        else:
-            if session[key] == value:
-                filtered_sessions.append(session)
 
-    return filtered_sessions
+def _encode_cursor(sort, position):
+    """Turn a position in a sorted list into an opaque cursor"""
+    return base64.urlsafe_b64encode(utf8(json_encode([sort] + list(position)))).decode()
+
+
+def _decode_cursor(sort, cursor):
+    """Get the position a cursor points to, raising ValueError if it's invalid"""
+    try:
+        cursor_sort, value, session_id = json_decode(
+            base64.urlsafe_b64decode(utf8(cursor))
+        )
+    except (binascii.Error, TypeError) as e:
+        raise ValueError(cursor) from e
+
+    order = sort.lstrip("-")
+    value_type = str if order in sessions.SEARCHABLE_FIELDS else int
+
+    # pylint: disable=C0123
+    if cursor_sort != sort or type(value) != value_type or type(session_id) != int:
+        raise ValueError(cursor)
+
+    return (value, session_id)
 
 
 # pylint: disable=W0223
 class Handler(RequestHandler):
     """Handler for all API requests"""
 
+    def initialize(self):
+        """Reset per-request state"""
+        self.etag = None
+        # Action to record the latency of this request for
+        self.metrics_action = None
+
+    def on_finish(self):
+        """Record how long the request took"""
+        if self.metrics_action is not None:
+            metrics.API_REQUEST_LATENCY.labels(
+                action=self.metrics_action, status=self.get_status()
+            ).observe(self.request.request_time())
+
+    def compute_etag(self):
+        """Use the precomputed ETag of cached responses if there is one"""
+        if self.etag is not None:
+            return self.etag
+
+        return super().compute_etag()
+
     def session_add(self):
         """Adds a new session"""
 
@@ -124,31 +225,71 @@ class Handler(RequestHandler):
         in_game = self.get_argument("in_game", default=None, strip=True)
         player_count = self.get_argument("player_count", default=None, strip=True)
 
-        if sessions.get_entry(secret) is None:
-            self.write({"status": "BAD_SESSION"})
+        status = _keep_alive(secret, time.time(), game, in_game, player_count)
+
+        if status == "BLACKLISTED_WORD":
+            self.write({"status": status, "parameter": "game"})
             self.set_status(400)
             return
 
-        sessions.SESSIONS[secret]["timestamp"] = time.time()
+        if status != "OK":
+            self.write({"status": status})
+            self.set_status(400)
+            return
 
-        if game is not None:
-            if database.is_string_blacklisted(game):
-                self.write({"status": "BLACKLISTED_WORD", "parameter": "game"})
-                self.set_status(400)
-                return
-            sessions.SESSIONS[secret]["game"] = game
+        self.write({"status": "OK"})
 
+    def session_active_batch(self):
+        """Keeps several sessions alive at once, see session_active"""
         try:
-            if in_game is not None:
-                sessions.SESSIONS[secret]["in_game"] = bool(int(in_game))
-            if player_count is not None:
-                sessions.SESSIONS[secret]["player_count"] = int(player_count)
+            updates = json_decode(self.get_argument("sessions", default="[]"))
         except ValueError:
+            updates = None
+
+        if not isinstance(updates, list) or not all(
+            isinstance(update, dict) for update in updates
+        ):
             self.write({"status": "PARSE_ERROR"})
             self.set_status(400)
             return
 
-        self.write({"status": "OK"})
+        if len(updates) > settings.MAXIMUM_SESSIONS_PER_HOST:
+            self.write({"status": "TOO_MANY_SESSIONS"})
+            self.set_status(400)
+            return
+
+        secrets = []
+        for update in updates:
+            secret = update.get("secret")
+            secrets.append(secret.strip() if isinstance(secret, str) else str(secret))
+
+        # Results are by secret, so every session may only be updated once
+        if len(set(secrets)) != len(secrets):
+            self.write({"status": "PARSE_ERROR"})
+            self.set_status(400)
+            return
+
+        timestamp = time.time()
+        results = {}
+
+        for secret, update in zip(secrets, updates):
+            game = update.get("game")
+
+            if not isinstance(update.get("secret"), str) or not isinstance(
+                game, (str, type(None))
+            ):
+                results[secret] = "PARSE_ERROR"
+                continue
+
+            results[secret] = _keep_alive(
+                secret,
+                timestamp,
+                None if game is None else game.strip(),
+                update.get("in_game"),
+                update.get("player_count"),
+            )
+
+        self.write({"status": "OK", "results": results})
 
     def session_remove(self):
         """Removes a session"""
@@ -165,53 +306,154 @@ class Handler(RequestHandler):
 
     def list(self):
         """List all sessions matching filter"""
-        # pylint: disable=W0603
-        global LAST_SESSION_CLEANUP
 
-        if time.time() - LAST_SESSION_CLEANUP > settings.SESSION_CLEANUP_DELAY:
-            LAST_SESSION_CLEANUP = time.time()
-            _cleanup_sessions()
+        since = self.get_argument("since", default=None)
+        sort = self.get_argument("sort", default=None)
+        limit = self.get_argument("limit", default=None)
+        cursor = self.get_argument("cursor", default=None)
 
-        name = self.get_argument("name", default=None)
-        game = self.get_argument("game", default=None)
-        password = self.get_argument("password", default=None)
-        region = self.get_argument("region", default=None)
-        version = self.get_argument("version", default=None)
-        in_game = self.get_argument("in_game", default=None)
+        try:
+            filters, search = get_filters(self)
 
-        filtered_sessions = list(sessions.get_all().values())
+            if since is not None:
+                since = int(since)
+
+            if limit is not None:
+                limit = min(int(limit), settings.LIST_MAX_PAGE_SIZE)
+                if limit < 1:
+                    raise ValueError(limit)
+        except ValueError:
+            self.write({"status": "PARSE_ERROR"})
+            self.set_status(400)
+            return
 
-        if name is not None:
-            filtered_sessions = _filter_string(filtered_sessions, "name", name, True)
+        # Pages need a stable order
+        if sort is None and (limit is not None or cursor is not None):
+            sort = "age"
 
-        if game is not None:
-            filtered_sessions = _filter_string(filtered_sessions, "game", game, True)
+        order = None
+        descending = False
+        after = None
 
-        if region is not None:
-            filtered_sessions = _filter_string(filtered_sessions, "region", region)
+        if sort is not None:
+            descending = sort.startswith("-")
+            order = sort[1:] if descending else sort
 
-        if version is not None:
-            filtered_sessions = _filter_string(filtered_sessions, "version", version)
+            if order not in sessions.ORDERS:
+                self.write({"status": "BAD_SORT"})
+                self.set_status(400)
+                return
 
-        try:
-            if password is not None:
-                filtered_sessions = _filter_string(
-                    filtered_sessions, "password", bool(int(password))
-                )
+        if cursor is not None:
+            try:
+                after = _decode_cursor(sort, cursor)
+            except ValueError:
+                self.write({"status": "BAD_CURSOR"})
+                self.set_status(400)
+                return
 
-            if in_game is not None:
-                filtered_sessions = _filter_string(
-                    filtered_sessions, "in_game", bool(int(in_game))
+        # Fall back to a full list if the change log doesn't reach back to since
+        changes = None
+        if since is not None:
+            changes = sessions.changes_since(since)
+            if changes is None:
+                since = None
+
+        key = (
+            sessions.generation,
+            since,
+            tuple(sorted(filters.items())),
+            tuple(sorted(search.items())),
+            sort,
+            limit,
+            after,
+        )
+        response = LIST_CACHE.get(key)
+
+        if response is None:
+            result = {"status": "OK", "revision": sessions.generation}
+
+            # Incremental responses are never sorted or paginated
+            if changes is None and order is None:
+                matching = sessions.find(filters, search)
+            elif changes is None:
+                candidates = None
+                if filters or search:
+                    candidates = sessions.find(filters, search)
+
+                matching = sessions.sort(
+                    order,
+                    candidates,
+                    descending,
+                    after,
+                    None if limit is None else limit + 1,
                 )
-        except ValueError:
-            self.write({"status": "PARSE_ERROR"})
-            self.set_status(400)
-            return
 
-        self.write({"status": "OK", "sessions": filtered_sessions})
+                if limit is not None and len(matching) > limit:
+                    matching = matching[:limit]
+                    result["cursor"] = _encode_cursor(
+                        sort, sessions.sort_key(order, matching[-1])
+                    )
+            else:
+                present = {
+                    secret
+                    for secret in changes
+                    if sessions.get_entry(secret) is not None
+                }
+                matching = sessions.find(filters, search, among=present)
+                matching_secrets = set(matching)
+
+                # Sessions the client may know that were removed or don't
+                # match anymore
+                result["removed"] = [
+                    session_id
+                    for secret, (session_id, added) in changes.items()
+                    if secret not in matching_secrets and not added
+                ]
+
+            result["sessions"] = [
+                sessions.get_entry(secret).to_listed_dict() for secret in matching
+            ]
+
+            body = utf8(json_encode(result))
+            response = (
+                body,
+                '"{}"'.format(hashlib.sha1(body).hexdigest()),
+                len(matching),
+            )
+            LIST_CACHE.put(key, response)
+
+        body, self.etag, size = response
+
+        metrics.API_LIST_RESULT_SIZE.observe(size)
+
+        self.set_header("Content-Type", "application/json; charset=UTF-8")
+        self.write(body)
 
     def get(self, api_version, action):
         """Answer get requests"""
+
+        # Checked before anything else so floods are turned away cheaply
+        if action not in settings.RATE_LIMITS:
+            action_limit = "other"
+        else:
+            action_limit = action
+
+        # Arbitrary actions would make for arbitrarily many label values
+        self.metrics_action = action_limit
+
+        rate, burst = settings.RATE_LIMITS[action_limit]
+        wait = RATE_LIMITER.take(
+            (get_rate_limit_key(get_ip(self)), action_limit), rate, burst
+        )
+
+        if wait:
+            metrics.API_THROTTLED_REQUEST_COUNT.labels(action=action_limit).inc()
+            self.set_header("Retry-After", str(math.ceil(wait)))
+            self.write({"status": "RATE_LIMITED"})
+            self.set_status(429)
+            return
+
         api_version = int(api_version)
         metrics.API_REQUEST_COUNT.inc()
         if api_version != 0:
@@ -233,6 +475,7 @@ class Handler(RequestHandler):
             "session/add": self.session_add,
             "session/remove": self.session_remove,
             "session/active": self.session_active,
+            "session/active_batch": self.session_active_batch,
             "list": self.list,
         }
 
@@ -0,0 +1,3 @@
+"""Benchmarks, run as e.g. python -m netplay_index.benchmarks.list_scaling"""
+
+name = "benchmarks"
@@ -0,0 +1,181 @@
+"""Measure /v0/list throughput for different numbers of worker processes
+
+Starts a fresh server per worker count, fills it with sessions and then
+polls /v0/list from several client processes at once."""
+
+import argparse
+import multiprocessing
+import os
+import random
+import subprocess
+import sys
+import tempfile
+import time
+import urllib.parse
+
+from tornado import gen
+from tornado.httpclient import AsyncHTTPClient, HTTPClientError
+from tornado.ioloop import IOLoop
+
+import netplay_index.settings as settings
+
+REPOSITORY = os.path.dirname(os.path.dirname(os.path.dirname(__file__)))
+
+
+def _session(index):
+    return {
+        "name": "Benchmark {}".format(index),
+        "region": random.choice(settings.VALID_REGIONS),
+        "game": "Game {}".format(index % 50),
+        "server_id": "benchmark",
+        "port": 2626,
+        "player_count": random.randint(1, 4),
+        "in_game": random.choice([0, 1]),
+        "password": random.choice([0, 1]),
+        "method": "traversal",
+        "version": "5.0-666",
+    }
+
+
+def _random_ip():
+    return "10.{}.{}.{}".format(*(random.randrange(256) for _ in range(3)))
+
+
+async def _wait_until_up(url):
+    client = AsyncHTTPClient()
+    for _ in range(100):
+        try:
+            await client.fetch(url + "/v0/list")
+            return
+        except (ConnectionError, HTTPClientError):
+            await gen.sleep(0.1)
+    raise RuntimeError("Server didn't come up")
+
+
+async def _populate(url, count):
+    client = AsyncHTTPClient()
+    for index in range(count):
+        # Every host may only have a few sessions. Requests from localhost
+        # are trusted to pass on the address of their client.
+        host = index // settings.MAXIMUM_SESSIONS_PER_HOST
+        await client.fetch(
+            "{}/v0/session/add?{}".format(url, urllib.parse.urlencode(_session(index))),
+            headers={
+                "X-Real-IP": "10.{}.{}.{}".format(
+                    host >> 16 & 255, host >> 8 & 255, host & 255
+                )
+            },
+        )
+
+
+async def _poll(url, concurrency, duration):
+    client = AsyncHTTPClient(max_clients=concurrency)
+    deadline = time.monotonic() + duration
+    done = 0
+
+    async def poller():
+        nonlocal done
+        while time.monotonic() < deadline:
+            region = random.choice(settings.VALID_REGIONS)
+            # Spread over many clients to stay within the rate limits
+            await client.fetch(
+                "{}/v0/list?region={}".format(url, region),
+                headers={"X-Real-IP": _random_ip()},
+            )
+            done += 1
+
+    await gen.multi([poller() for _ in range(concurrency)])
+    return done
+
+
+def _client(args):
+    url, concurrency, duration = args
+    return IOLoop.current().run_sync(
+        lambda: _poll(url, concurrency, duration), timeout=duration + 30
+    )
+
+
+def run(workers, args):
+    """Return requests per second for a server with workers processes"""
+    url = "http://127.0.0.1:{}".format(args.port)
+    env = dict(os.environ, PYTHONPATH=REPOSITORY, SESSION_SNAPSHOT_PATH="")
+    env.setdefault(
+        "GEOIP_DATABASE_PATH",
+        os.path.join(REPOSITORY, "testdata", "GeoLite2-Country.mmdb"),
+    )
+    env["GEOIP_DATABASE_PATH"] = os.path.abspath(env["GEOIP_DATABASE_PATH"])
+
+    with tempfile.TemporaryDirectory() as directory:
+        server = subprocess.Popen(
+            [
+                sys.executable,
+                "-m",
+                "netplay_index",
+                "--port={}".format(args.port),
+                "--workers={}".format(workers),
+                "--logging=none",
+            ],
+            cwd=directory,
+            env=env,
+            stdout=subprocess.DEVNULL,
+            # Stopping the server signals its whole process group
+            start_new_session=True,
+        )
+
+        try:
+            IOLoop.current().run_sync(lambda: _wait_until_up(url), timeout=30)
+            IOLoop.current().run_sync(
+                lambda: _populate(url, args.sessions), timeout=300
+            )
+            # Give replicas a moment to catch up
+            time.sleep(settings.REPLICATION_DELAY * 10)
+
+            with multiprocessing.Pool(args.clients) as pool:
+                done = pool.map(
+                    _client, [(url, args.concurrency, args.duration)] * args.clients
+                )
+        finally:
+            # The parent exits once all of its workers did
+            server.terminate()
+            server.wait()
+
+    return sum(done) / args.duration
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument(
+        "--workers", default="1,2,4", help="Comma-separated worker counts to try"
+    )
+    parser.add_argument("--sessions", type=int, default=2000)
+    parser.add_argument(
+        "--clients",
+        type=int,
+        default=os.cpu_count(),
+        help="Number of client processes",
+    )
+    parser.add_argument(
+        "--concurrency", type=int, default=16, help="Requests in flight per client"
+    )
+    parser.add_argument(
+        "--duration",
+        type=float,
+        default=5,
+        help="Seconds to poll for, sessions time out after {}".format(
+            settings.SESSION_TIMEOUT_SECONDS
+        ),
+    )
+    parser.add_argument("--port", type=int, default=8765)
+    args = parser.parse_args()
+
+    baseline = None
+
+    print("workers  requests/s  speedup")
+    for workers in [int(workers) for workers in args.workers.split(",")]:
+        rate = run(workers, args)
+        baseline = baseline or rate
+        print("{:7}  {:10.0f}  {:6.2f}x".format(workers, rate, rate / baseline))
+
+
+if __name__ == "__main__":
+    main()
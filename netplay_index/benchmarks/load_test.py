@@ -0,0 +1,326 @@
+"""Simulate hosts and lobby browsers against the index and measure it
+
+Serves make_app() from a separate process. Simulated hosts add a session,
+keep it alive and remove it at the end; simulated browsers poll /v0/list
+with a mix of filters. Prints throughput and latency percentiles per action
+and how late the server's event loop ran callbacks, as JSON."""
+
+import argparse
+import contextlib
+import io
+import json
+import multiprocessing
+import os
+import random
+import time
+import urllib.parse
+
+from tornado import gen
+from tornado.httpclient import AsyncHTTPClient
+from tornado.httpserver import HTTPServer
+from tornado.ioloop import IOLoop
+
+import netplay_index.settings as settings
+
+REPOSITORY = os.path.dirname(os.path.dirname(os.path.dirname(__file__)))
+
+# How often the server checks how late its event loop runs, in seconds
+LAG_INTERVAL = 0.01
+
+GAMES = ["Super Smash Bros. Melee", "Mario Kart: Double Dash!!", "Mario Party 4"]
+GAMES += ["Game {}".format(index) for index in range(50)]
+
+VERSIONS = ["5.0-{}".format(build) for build in range(17000, 17010)]
+
+# Lobby filters and how often browsers use them
+FILTERS = [
+    (40, lambda: {}),
+    (20, lambda: {"region": random.choice(settings.VALID_REGIONS)}),
+    (
+        15,
+        lambda: {
+            "version": random.choice(VERSIONS),
+            "region": random.choice(settings.VALID_REGIONS),
+        },
+    ),
+    (10, lambda: {"in_game": 0, "password": 0}),
+    (10, lambda: {"game": random.choice(GAMES).split()[0]}),
+    (5, lambda: {"name": "host 1"}),
+]
+
+
+def _serve(port, connection, rate_limits):
+    """Run the index until something is sent on connection, then send back
+    how late the event loop was"""
+
+    # pylint: disable=C0415
+    import netplay_index.__main__ as netplay_index
+    import netplay_index.api as api
+
+    settings.DATABASE_PATH = ":memory:"
+    if not rate_limits:
+        settings.RATE_LIMITS = {action: (1e9, 1e9) for action in settings.RATE_LIMITS}
+
+    # Keep stdout clean for the results
+    with contextlib.redirect_stdout(io.StringIO()):
+        app = netplay_index.make_app()
+
+    server = HTTPServer(app)
+    server.listen(port, "127.0.0.1")
+    api.start_session_cleanup()
+
+    loop = IOLoop.current()
+    lags = []
+    expected = time.monotonic() + LAG_INTERVAL
+
+    def measure():
+        nonlocal expected
+        now = time.monotonic()
+        lags.append(max(0, now - expected))
+        expected = now + LAG_INTERVAL
+        loop.call_later(LAG_INTERVAL, measure)
+
+    def stop(fd, events):
+        # pylint: disable=W0613
+        connection.send(lags)
+        loop.stop()
+
+    loop.call_later(LAG_INTERVAL, measure)
+    loop.add_handler(connection.fileno(), stop, IOLoop.READ)
+    connection.send("ready")
+    loop.start()
+
+
+def _session(index):
+    return {
+        "name": "Host {}".format(index),
+        "region": random.choice(settings.VALID_REGIONS),
+        "game": random.choice(GAMES),
+        "server_id": "load-test",
+        "port": 2626,
+        "player_count": 1,
+        "in_game": 0,
+        "password": random.choice([0, 0, 0, 1]),
+        "method": random.choice(["direct", "traversal"]),
+        "version": random.choice(VERSIONS),
+    }
+
+
+def _ip(prefix, index):
+    return "{}.{}.{}.{}".format(
+        prefix, index >> 16 & 255, index >> 8 & 255, index & 255
+    )
+
+
+class Recorder:
+    """Latencies and errors of requests, by action"""
+
+    def __init__(self, url, max_clients):
+        self.url = url
+        self.client = AsyncHTTPClient(max_clients=max_clients, force_instance=True)
+        self.latencies = {}
+        self.errors = {}
+
+    async def fetch(self, action, arguments, ip):
+        """Call action, returning the decoded response or None on errors"""
+        start = time.perf_counter()
+        response = await self.client.fetch(
+            "{}/v0/{}?{}".format(self.url, action, urllib.parse.urlencode(arguments)),
+            headers={"X-Real-IP": ip},
+            raise_error=False,
+        )
+        self.latencies.setdefault(action, []).append(time.perf_counter() - start)
+
+        if response.code != 200:
+            self.errors[action] = self.errors.get(action, 0) + 1
+            return None
+
+        return json.loads(response.body)
+
+
+async def _host(recorder, index, args, deadline):
+    ip = _ip(10, index)
+    await gen.sleep(random.uniform(0, args.active_interval))
+
+    session = _session(index)
+    response = await recorder.fetch("session/add", session, ip)
+    if response is None:
+        return
+
+    secret = response["secret"]
+
+    while time.monotonic() + args.active_interval < deadline:
+        await gen.sleep(args.active_interval)
+        session["player_count"] = random.randint(1, 4)
+        await recorder.fetch(
+            "session/active",
+            {"secret": secret, "player_count": session["player_count"]},
+            ip,
+        )
+
+    await recorder.fetch("session/remove", {"secret": secret}, ip)
+
+
+async def _browser(recorder, index, args, deadline):
+    ip = _ip(172, index)
+    await gen.sleep(random.uniform(0, args.browse_interval))
+
+    weights = [weight for weight, _ in FILTERS]
+    while time.monotonic() < deadline:
+        filters = random.choices(FILTERS, weights)[0][1]()
+        await recorder.fetch("list", filters, ip)
+        await gen.sleep(args.browse_interval)
+
+
+def _drive(task):
+    """Run some of the simulated clients, returning their latencies and errors"""
+    url, hosts, browsers, args = task
+
+    async def run():
+        recorder = Recorder(url, len(hosts) + len(browsers))
+        deadline = time.monotonic() + args.duration
+        await gen.multi(
+            [_host(recorder, index, args, deadline) for index in hosts]
+            + [_browser(recorder, index, args, deadline) for index in browsers]
+        )
+        return recorder.latencies, recorder.errors
+
+    return IOLoop.current().run_sync(run, timeout=args.duration + 60)
+
+
+def _percentile(values, percentile):
+    """Nearest-rank percentile of sorted values"""
+    if not values:
+        return None
+    return values[min(len(values) - 1, int(len(values) * percentile / 100))]
+
+
+def _summary(values, duration):
+    values = sorted(values)
+    return {
+        "count": len(values),
+        "throughput": len(values) / duration,
+        "p50": _percentile(values, 50),
+        "p99": _percentile(values, 99),
+        "p999": _percentile(values, 99.9),
+        "max": values[-1] if values else None,
+    }
+
+
+def run(args):
+    """Return the results of a load test as a dict"""
+    os.environ["GEOIP_DATABASE_PATH"] = os.path.abspath(
+        os.environ.get(
+            "GEOIP_DATABASE_PATH",
+            os.path.join(REPOSITORY, "testdata", "GeoLite2-Country.mmdb"),
+        )
+    )
+
+    # A fresh interpreter, so the server shares no state with the clients
+    context = multiprocessing.get_context("spawn")
+    connection, server_connection = context.Pipe()
+    server = context.Process(
+        target=_serve, args=(args.port, server_connection, args.rate_limits)
+    )
+    server.start()
+
+    try:
+        connection.recv()
+
+        url = "http://127.0.0.1:{}".format(args.port)
+        tasks = [
+            (
+                url,
+                range(process, args.hosts, args.processes),
+                range(process, args.browsers, args.processes),
+                args,
+            )
+            for process in range(args.processes)
+        ]
+
+        with context.Pool(args.processes) as pool:
+            results = pool.map(_drive, tasks)
+
+        connection.send("stop")
+        lags = sorted(connection.recv())
+    finally:
+        server.join(5)
+        if server.is_alive():
+            server.terminate()
+
+    latencies = {}
+    errors = {}
+    for process_latencies, process_errors in results:
+        for action, values in process_latencies.items():
+            latencies.setdefault(action, []).extend(values)
+        for action, count in process_errors.items():
+            errors[action] = errors.get(action, 0) + count
+
+    actions = {}
+    for action, values in sorted(latencies.items()):
+        actions[action] = _summary(values, args.duration)
+        actions[action]["errors"] = errors.get(action, 0)
+
+    loop_lag = _summary(lags, args.duration)
+    del loop_lag["throughput"]
+
+    return {
+        "config": {
+            "hosts": args.hosts,
+            "browsers": args.browsers,
+            "duration": args.duration,
+            "active_interval": args.active_interval,
+            "browse_interval": args.browse_interval,
+            "processes": args.processes,
+            "rate_limits": args.rate_limits,
+        },
+        "actions": actions,
+        "loop_lag": loop_lag,
+    }
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument("--hosts", type=int, default=500)
+    parser.add_argument("--browsers", type=int, default=200)
+    parser.add_argument("--duration", type=float, default=30, help="In seconds")
+    parser.add_argument(
+        "--active-interval",
+        type=float,
+        default=5,
+        help="Seconds between keep-alives of a host, sessions time out after {}".format(
+            settings.SESSION_TIMEOUT_SECONDS
+        ),
+    )
+    parser.add_argument(
+        "--browse-interval",
+        type=float,
+        default=1,
+        help="Seconds between two lists of a browser, 0 to poll as fast as possible",
+    )
+    parser.add_argument(
+        "--processes",
+        type=int,
+        default=os.cpu_count(),
+        help="Number of client processes",
+    )
+    parser.add_argument(
+        "--rate-limits",
+        action="store_true",
+        help="Enforce the per-IP rate limits, off by default",
+    )
+    parser.add_argument("--port", type=int, default=8766)
+    parser.add_argument("--output", help="Write the results here instead of stdout")
+    args = parser.parse_args()
+
+    results = json.dumps(run(args), indent=2, sort_keys=True)
+
+    if args.output:
+        with open(args.output, "w") as output:
+            output.write(results + "\n")
+    else:
+        print(results)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,287 @@
+"""Time the functions on the request path and compare them to a baseline
+
+Every benchmark runs at several scales, e.g. numbers of sessions or bans.
+With --save, the results become the new baseline. Otherwise they're compared
+to the baseline and the exit status is 1 if any benchmark got slower by more
+than --threshold percent."""
+
+import argparse
+import ipaddress
+import json
+import os
+import random
+import sys
+import time
+import timeit
+
+import netplay_index.settings as settings
+
+REPOSITORY = os.path.dirname(os.path.dirname(os.path.dirname(__file__)))
+BASELINE = os.path.join(
+    REPOSITORY, "netplay_index", "benchmarks", "micro_baseline.json"
+)
+
+SESSION_SCALES = [1000, 10000, 100000]
+BLACKLIST_SCALES = [10, 1000, 10000]
+BAN_SCALES = [10, 100000]
+
+# Words sessions are named after, so searches find something
+WORDS = ["melee", "netplay", "brawl", "kart", "party", "lobby", "casual", "ranked"]
+
+
+def _random_ip():
+    return str(ipaddress.IPv4Address(random.getrandbits(32)))
+
+
+def _session(timestamp):
+    return {
+        "name": "{} {} {}".format(
+            random.choice(WORDS), random.choice(WORDS), random.randrange(1000)
+        ),
+        "region": random.choice(settings.VALID_REGIONS),
+        "game": "Game {}".format(random.randrange(500)),
+        "server_id": "benchmark",
+        "port": 2626,
+        "player_count": random.randint(1, 4),
+        "in_game": random.choice([True, False]),
+        "password": random.choice([True, False]),
+        "method": random.choice(["direct", "traversal"]),
+        "version": "5.0-{}".format(random.randrange(17000, 17010)),
+        "timestamp": timestamp,
+    }
+
+
+def _time(statement, setup=None, repeat=5):
+    """Return the best time per call of statement, in seconds
+
+    setup runs before every call if given, otherwise calls are batched."""
+    if setup is not None:
+        times = []
+        for _ in range(repeat):
+            setup()
+            start = time.perf_counter()
+            statement()
+            times.append(time.perf_counter() - start)
+        return min(times)
+
+    timer = timeit.Timer(statement)
+    number, _ = timer.autorange()
+    return min(timer.repeat(repeat, number)) / number
+
+
+# Benchmarks are generators of names and functions measuring them, so only
+# the selected ones are run
+
+
+def _session_benchmarks(sessions, api):
+    for scale in SESSION_SCALES:
+        now = time.time()
+        hosts = [
+            _random_ip() for _ in range(scale // settings.MAXIMUM_SESSIONS_PER_HOST)
+        ]
+        secrets = [
+            sessions.add_entry(_session(now + 3600), hosts[index % len(hosts)])
+            for index in range(scale)
+        ]
+
+        def expire_some():
+            # One in a hundred sessions timed out since the last pass
+            for _ in range(scale // 100):
+                sessions.add_entry(_session(0), random.choice(hosts))
+
+        yield (
+            "sessions.find[search,sessions={}]".format(scale),
+            lambda: _time(lambda: sessions.find({}, {"name": "melee"})),
+        )
+        yield (
+            "sessions.find[region+search,sessions={}]".format(scale),
+            lambda: _time(lambda: sessions.find({"region": "EU"}, {"game": "game 4"})),
+        )
+        yield (
+            "sessions.get_host_session_count[sessions={}]".format(scale),
+            lambda: _time(
+                lambda: sessions.get_host_session_count(random.choice(hosts))
+            ),
+        )
+        yield (
+            "api._cleanup_sessions[idle,sessions={}]".format(scale),
+            lambda: _time(api._cleanup_sessions),
+        )
+        yield (
+            "api._cleanup_sessions[1%,sessions={}]".format(scale),
+            lambda: _time(api._cleanup_sessions, setup=expire_some),
+        )
+
+        for secret in secrets:
+            sessions.remove_entry(secret)
+
+
+def _blacklist_benchmarks(database):
+    for scale in BLACKLIST_SCALES:
+        database.CONNECTION.execute("DELETE FROM blacklist")
+        database.CONNECTION.executemany(
+            database.BLACKLIST_ADD,
+            [("word{}".format(index), "benchmark", "") for index in range(scale)],
+        )
+        database.CONNECTION.commit()
+        database._load_blacklist()
+
+        name = "{} {} lobby".format(random.choice(WORDS), random.choice(WORDS))
+        yield (
+            "database.is_string_blacklisted[words={}]".format(scale),
+            lambda: _time(lambda: database.is_string_blacklisted(name)),
+        )
+
+    database.CONNECTION.execute("DELETE FROM blacklist")
+    database.CONNECTION.commit()
+    database._load_blacklist()
+
+
+def _ban_benchmarks(database):
+    for scale in BAN_SCALES:
+        # Mostly single addresses, some networks
+        bans = [
+            _random_ip()
+            if index % 10
+            else str(ipaddress.ip_network("{}/24".format(_random_ip()), strict=False))
+            for index in range(scale)
+        ]
+
+        database.CONNECTION.execute("DELETE FROM bans")
+        database.CONNECTION.executemany(
+            database.BAN_ADD, [(host, "benchmark", "") for host in set(bans)]
+        )
+        database.CONNECTION.commit()
+        database.reload_bans()
+
+        yield (
+            "database.is_host_banned[ipv4,bans={}]".format(scale),
+            lambda: _time(lambda: database.is_host_banned("192.0.2.1")),
+        )
+        yield (
+            "database.is_host_banned[ipv6,bans={}]".format(scale),
+            lambda: _time(lambda: database.is_host_banned("2001:db8::1")),
+        )
+
+    database.CONNECTION.execute("DELETE FROM bans")
+    database.CONNECTION.commit()
+    database.reload_bans()
+
+
+def _util_benchmarks(util):
+    ips = [_random_ip() for _ in range(settings.GEOIP_CACHE_SIZE * 4)]
+    misses = iter(ips * 1000)
+
+    yield (
+        "util.get_ip_region[cached]",
+        lambda: _time(lambda: util.get_ip_region("8.8.8.8")),
+    )
+    yield (
+        "util.get_ip_region[uncached]",
+        lambda: _time(lambda: util.get_ip_region(next(misses))),
+    )
+    yield "util.generate_secret", lambda: _time(util.generate_secret)
+
+
+def run(selection=None):
+    """Return the seconds per call of every benchmark, by name"""
+
+    # pylint: disable=C0415
+    import netplay_index.api as api
+    import netplay_index.database as database
+    import netplay_index.sessions as sessions
+    import netplay_index.util as util
+
+    database.initialize(":memory:")
+
+    benchmarks = [
+        _session_benchmarks(sessions, api),
+        _blacklist_benchmarks(database),
+        _ban_benchmarks(database),
+        _util_benchmarks(util),
+    ]
+
+    results = {}
+    for benchmark in benchmarks:
+        for name, measure in benchmark:
+            if selection is None or selection in name:
+                seconds = measure()
+                results[name] = seconds
+                print("{:60} {:12.3f} us".format(name, seconds * 1e6), file=sys.stderr)
+
+    return results
+
+
+def compare(results, baseline, threshold):
+    """Return the benchmarks slower than their baseline by more than
+    threshold percent, as (name, baseline, result)"""
+    return [
+        (name, baseline[name], seconds)
+        for name, seconds in sorted(results.items())
+        if name in baseline and seconds > baseline[name] * (1 + threshold / 100)
+    ]
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument(
+        "--baseline",
+        default=BASELINE,
+        help="File to compare to, or to save to with --save",
+    )
+    parser.add_argument(
+        "--save", action="store_true", help="Save the results as the new baseline"
+    )
+    parser.add_argument(
+        "--threshold",
+        type=float,
+        default=20,
+        help="Percentage by which a benchmark may get slower",
+    )
+    parser.add_argument("--filter", help="Only run benchmarks containing this")
+    args = parser.parse_args()
+
+    os.environ.setdefault(
+        "GEOIP_DATABASE_PATH",
+        os.path.join(REPOSITORY, "testdata", "GeoLite2-Country.mmdb"),
+    )
+    settings.GEOIP_DATABASE_PATH = os.environ["GEOIP_DATABASE_PATH"]
+
+    try:
+        with open(args.baseline) as baseline_file:
+            baseline = json.load(baseline_file)
+    except FileNotFoundError:
+        if not args.save:
+            print(
+                "No baseline at {}, create one with --save first".format(args.baseline),
+                file=sys.stderr,
+            )
+            sys.exit(1)
+        baseline = {}
+
+    results = run(args.filter)
+
+    if args.save:
+        # Benchmarks that weren't run keep their old baseline
+        baseline.update(results)
+        with open(args.baseline, "w") as baseline_file:
+            json.dump(baseline, baseline_file, indent=2, sort_keys=True)
+        return
+
+    regressions = compare(results, baseline, args.threshold)
+
+    for name, before, after in regressions:
+        print(
+            "{} regressed: {:.3f} us -> {:.3f} us ({:+.0f}%)".format(
+                name, before * 1e6, after * 1e6, (after / before - 1) * 100
+            )
+        )
+
+    if regressions:
+        sys.exit(1)
+
+    print("No regressions beyond {}%".format(args.threshold))
+
+
+if __name__ == "__main__":
+    main()
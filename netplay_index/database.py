@@ -1,21 +1,201 @@
 """Database helper"""
 
+from concurrent.futures import ThreadPoolExecutor
+import ipaddress
 import sqlite3
 import bcrypt
 import re
 
+from tornado.ioloop import IOLoop
+
+import netplay_index.metrics as metrics
+import netplay_index.settings as settings
+
+# Connection used on the event loop, for reading
 CONNECTION = None
+
+# Connection used by WRITER, only ever touched on its thread
+WRITER_CONNECTION = None
+
+# Single thread making all changes, so slow commits never hold up requests
+WRITER = None
+
 DB_REVISION = 0
 
+# Name of the in-memory database shared by all connections of this process
+MEMORY_URI = "file:netplay_index?mode=memory&cache=shared"
+
+# Single pattern matching any blacklisted word, None if the blacklist is empty
+BLACKLIST_PATTERN = None
+
+# Patterns of blacklisted words with groups of their own, which would get
+# renumbered in BLACKLIST_PATTERN
+BLACKLIST_GROUP_PATTERNS = []
+
+# Banned hosts that are neither IP addresses nor networks, matched verbatim
+BANNED_HOSTS = set()
+
+# Banned networks, by IP version and prefix length, as sets of network prefixes
+BANNED_NETWORKS = {4: {}, 6: {}}
+
+# bcrypt is slow on purpose, so it runs here instead of on the event loop
+HASH_EXECUTOR = ThreadPoolExecutor(settings.PASSWORD_HASH_THREADS)
+
+# Incremented whenever the bans are reloaded
+BANS_REVISION = 0
+
+# Permissions of users who used the admin interface, by username
+PERMISSIONS = {}
+
 
 def _get_cursor():
     """Returns a connection cursor"""
     return CONNECTION.cursor()
 
 
-def _commit():
-    """Commit database changes"""
-    CONNECTION.commit()
+def _connect(path):
+    """Open a connection to the database at path"""
+
+    if path == ":memory:":
+        connection = sqlite3.connect(
+            MEMORY_URI,
+            uri=True,
+            cached_statements=settings.DATABASE_CACHED_STATEMENTS,
+        )
+        # Shared-cache connections lock whole tables, don't let reads wait for
+        # the writer
+        connection.execute("PRAGMA read_uncommitted = 1")
+        return connection
+
+    connection = sqlite3.connect(
+        path,
+        timeout=settings.DATABASE_BUSY_TIMEOUT,
+        cached_statements=settings.DATABASE_CACHED_STATEMENTS,
+    )
+    # Readers don't block the writer and commits don't need to wait for
+    # every write to reach the disk
+    connection.execute("PRAGMA journal_mode = WAL")
+    connection.execute("PRAGMA synchronous = NORMAL")
+
+    return connection
+
+
+def _open_writer(path):
+    # pylint: disable=W0603
+    global WRITER_CONNECTION
+
+    WRITER_CONNECTION = _connect(path)
+
+
+def _close_writer():
+    # pylint: disable=W0603
+    global WRITER_CONNECTION
+
+    WRITER_CONNECTION.close()
+    WRITER_CONNECTION = None
+
+
+def _execute(statement, parameters):
+    """Execute statement on WRITER and commit it"""
+    WRITER_CONNECTION.execute(statement, parameters)
+    WRITER_CONNECTION.commit()
+
+
+def _write(statement, parameters):
+    """Change the database, waiting until the change is committed"""
+    WRITER.submit(_execute, statement, parameters).result()
+
+
+def _write_async(statement, parameters):
+    """Change the database, returning a future resolved once it's committed"""
+    return IOLoop.current().run_in_executor(WRITER, _execute, statement, parameters)
+
+
+def _word_pattern(word):
+    return r"\b(?:{0})\b".format(word)
+
+
+def _load_blacklist():
+    """Compile all blacklisted words into one pattern"""
+
+    # pylint: disable=W0603
+    global BLACKLIST_PATTERN, BLACKLIST_GROUP_PATTERNS
+
+    cur = _get_cursor()
+
+    cur.execute("SELECT word FROM blacklist")
+
+    words = []
+    group_patterns = []
+
+    for word in cur.fetchall():
+        word = word[0]
+        # A single broken pattern must not take the whole blacklist down with
+        # it, e.g. one with inline flags that only work at the very start
+        try:
+            pattern = re.compile(_word_pattern(word), flags=re.IGNORECASE)
+        except re.error:
+            words.append(re.escape(word))
+            continue
+
+        if pattern.groups:
+            group_patterns.append(pattern)
+        else:
+            words.append(word)
+
+    BLACKLIST_GROUP_PATTERNS = group_patterns
+
+    if not words:
+        BLACKLIST_PATTERN = None
+        return
+
+    try:
+        BLACKLIST_PATTERN = re.compile(
+            _word_pattern("|".join("(?:{0})".format(word) for word in words)),
+            flags=re.IGNORECASE,
+        )
+    except re.error:
+        # Words that only break in combination are matched verbatim
+        BLACKLIST_PATTERN = re.compile(
+            _word_pattern("|".join(re.escape(word) for word in words)),
+            flags=re.IGNORECASE,
+        )
+
+
+def _load_bans():
+    """Load all bans into memory"""
+
+    # pylint: disable=W0603
+    global BANNED_HOSTS, BANNED_NETWORKS, BANS_REVISION
+
+    cur = _get_cursor()
+
+    cur.execute("SELECT host FROM bans")
+
+    hosts = set()
+    networks = {4: {}, 6: {}}
+
+    for host in cur.fetchall():
+        host = host[0]
+        try:
+            network = ipaddress.ip_network(host, strict=False)
+        except ValueError:
+            hosts.add(host)
+            continue
+
+        prefix = int(network.network_address) >> (
+            network.max_prefixlen - network.prefixlen
+        )
+        networks[network.version].setdefault(network.prefixlen, set()).add(prefix)
+
+    BANNED_HOSTS = hosts
+    BANNED_NETWORKS = networks
+    BANS_REVISION += 1
+
+
+def reload_bans():
+    """Pick up bans changed by another process"""
+    _load_bans()
 
 
 def _hash_password(password):
@@ -24,13 +204,27 @@ def _hash_password(password):
     return bcrypt.hashpw(password.encode("UTF-8"), bcrypt.gensalt())
 
 
-def initialize():
-    """Initialize database before usage"""
+def _hash_password_async(password):
+    """Hashes a password in HASH_EXECUTOR"""
+
+    return IOLoop.current().run_in_executor(HASH_EXECUTOR, _hash_password, password)
+
+
+def initialize(path=None):
+    """Initialize database before usage
+
+    Does nothing but check the schema if the database is open already."""
 
     # pylint: disable=W0603
-    global CONNECTION
+    global CONNECTION, WRITER
 
-    CONNECTION = sqlite3.connect("main.db")
+    if CONNECTION is None:
+        path = path or settings.DATABASE_PATH
+
+        CONNECTION = _connect(path)
+        WRITER = ThreadPoolExecutor(1, thread_name_prefix="database-writer")
+        WRITER.submit(_open_writer, path).result()
+        PERMISSIONS.clear()
 
     cur = _get_cursor()
 
@@ -70,96 +264,149 @@ CREATE TABLE IF NOT EXISTS blacklist
 """
     )
 
+    _load_blacklist()
+    _load_bans()
+
     print("Initialized database successfully.")
 
     return True
 
 
+def close():
+    """Close the database, e.g. before forking"""
+
+    # pylint: disable=W0603
+    global CONNECTION, WRITER
+
+    WRITER.submit(_close_writer).result()
+    WRITER.shutdown()
+    WRITER = None
+
+    CONNECTION.close()
+    CONNECTION = None
+
+
+ADD_LOGIN = """INSERT INTO users
+(username, password, sysop, can_ban, can_modify_blacklist)
+VALUES (?, ?, ?, ?, ?)"""
+
+UPDATE_LOGIN = """
+UPDATE users SET password = ? WHERE username = ?"""
+
+DELETE_LOGIN = "DELETE FROM users WHERE username=?"
+
+
 def add_login(
     username, password, sysop=False, can_ban_user=False, can_modify_blacklist=False
 ):
     """Add user"""
-    cur = _get_cursor()
-
-    cur.execute(
-        """INSERT INTO users
-(username, password, sysop, can_ban, can_modify_blacklist)
-VALUES (?, ?, ?, ?, ?)""",
-        (username, _hash_password(password), sysop, can_ban_user, can_modify_blacklist),
+    _write(
+        ADD_LOGIN,
+        (
+            username,
+            _hash_password(password),
+            sysop,
+            can_ban_user,
+            can_modify_blacklist,
+        ),
     )
+    _forget_permissions(username)
+
 
-    _commit()
+async def add_login_async(
+    username, password, sysop=False, can_ban_user=False, can_modify_blacklist=False
+):
+    """Add user without hashing the password or writing on the event loop"""
+    await _write_async(
+        ADD_LOGIN,
+        (
+            username,
+            await _hash_password_async(password),
+            sysop,
+            can_ban_user,
+            can_modify_blacklist,
+        ),
+    )
+    _forget_permissions(username)
 
 
 def update_login(username, password):
     """Change login information"""
-    cur = _get_cursor()
-    cur.execute(
-        """
-UPDATE users SET password = ? WHERE username = ?""",
-        (_hash_password(password), username),
-    )
+    _write(UPDATE_LOGIN, (_hash_password(password), username))
+    _forget_permissions(username)
 
-    _commit()
 
+async def update_login_async(username, password):
+    """Change login information without hashing or writing on the event loop"""
+    await _write_async(UPDATE_LOGIN, (await _hash_password_async(password), username))
+    _forget_permissions(username)
 
-def is_sysop(username):
-    """Checks whether a user is sysop"""
 
-    cur = _get_cursor()
+class Permissions:
+    """What a user is allowed to do"""
 
-    cur.execute("SELECT sysop FROM users WHERE username=?", [username])
+    __slots__ = ("sysop", "can_ban", "can_modify_blacklist")
 
-    value = cur.fetchone()
+    def __init__(self, sysop=False, can_ban_user=False, can_modify_blacklist=False):
+        self.sysop = bool(sysop)
+        # Sysops can do everything
+        self.can_ban = self.sysop or bool(can_ban_user)
+        self.can_modify_blacklist = self.sysop or bool(can_modify_blacklist)
 
-    if value is None:
-        return False
 
-    return value[0]
+def _forget_permissions(username):
+    """Drop cached permissions after changing a user"""
+    PERMISSIONS.pop(username, None)
 
 
-def can_ban(username):
-    """Check whether a user can ban hosts"""
+def get_permissions(username):
+    """Get a user's permissions, only asking the database the first time"""
 
-    if is_sysop(username):
-        return True
+    permissions = PERMISSIONS.get(username)
+
+    if permissions is not None:
+        return permissions
 
     cur = _get_cursor()
 
-    cur.execute("SELECT can_ban FROM users WHERE username=?", [username])
+    cur.execute(
+        "SELECT sysop, can_ban, can_modify_blacklist FROM users WHERE username=?",
+        [username],
+    )
 
     value = cur.fetchone()
 
-    if value is None:
-        return False
-
-    return value[0]
-
+    permissions = Permissions() if value is None else Permissions(*value)
+    PERMISSIONS[username] = permissions
 
-def can_modify_blacklist(username):
-    """Checks whether a user can modify a blacklist"""
+    return permissions
 
-    if is_sysop(username):
-        return True
 
-    cur = _get_cursor()
+def is_sysop(username):
+    """Checks whether a user is sysop"""
+    return get_permissions(username).sysop
 
-    cur.execute("SELECT can_modify_blacklist FROM users WHERE username=?", [username])
 
-    value = cur.fetchone()
+def can_ban(username):
+    """Check whether a user can ban hosts"""
+    return get_permissions(username).can_ban
 
-    if value is None:
-        return False
 
-    return value[0]
+def can_modify_blacklist(username):
+    """Checks whether a user can modify a blacklist"""
+    return get_permissions(username).can_modify_blacklist
 
 
 def delete_login(username):
     """Remove user"""
-    cur = _get_cursor()
+    _write(DELETE_LOGIN, [username])
+    _forget_permissions(username)
+
 
-    cur.execute("DELETE FROM users WHERE username=?", [username])
-    _commit()
+async def delete_login_async(username):
+    """Remove user without writing on the event loop"""
+    await _write_async(DELETE_LOGIN, [username])
+    _forget_permissions(username)
 
 
 def login_exists(username):
@@ -173,8 +420,7 @@ def login_exists(username):
     return value is not None
 
 
-def check_login(username, password):
-    """Check whether a given username and password pair is valid"""
+def _get_password_hash(username):
     cur = _get_cursor()
 
     cur.execute("SELECT password FROM users WHERE username=?", [username])
@@ -183,13 +429,33 @@ def check_login(username, password):
 
     if hashed_password is None:
         print("Attempted login for non-existent user '{}'".format(username))
-        return False
+        return None
 
-    hashed_password = hashed_password[0]
+    return hashed_password[0]
+
+
+def check_login(username, password):
+    """Check whether a given username and password pair is valid"""
+    hashed_password = _get_password_hash(username)
+
+    if hashed_password is None:
+        return False
 
     return bcrypt.checkpw(password.encode("UTF-8"), hashed_password)
 
 
+async def check_login_async(username, password):
+    """Like check_login, but without checking the password on the event loop"""
+    hashed_password = _get_password_hash(username)
+
+    if hashed_password is None:
+        return False
+
+    return await IOLoop.current().run_in_executor(
+        HASH_EXECUTOR, bcrypt.checkpw, password.encode("UTF-8"), hashed_password
+    )
+
+
 def get_users():
     """Get all users"""
     cur = _get_cursor()
@@ -217,75 +483,98 @@ def blacklist_get():
     return cur.fetchall()
 
 
+BLACKLIST_ADD = """
+INSERT INTO blacklist(word, added_by, reason)
+VALUES (?, ?, ?)"""
+
+BLACKLIST_REMOVE = "DELETE FROM blacklist WHERE word=?"
+
+BAN_ADD = "INSERT INTO bans(host, added_by, reason) VALUES (?, ?, ?)"
+
+BAN_REMOVE = "DELETE FROM bans WHERE host=?"
+
+
 def blacklist_add(word, user, reason):
     """Add a word to the blacklist"""
-    cur = _get_cursor()
+    _write(BLACKLIST_ADD, [word, user, reason])
+    _load_blacklist()
 
-    cur.execute(
-        """
-INSERT INTO blacklist(word, added_by, reason)
-VALUES (?, ?, ?)""",
-        [word, user, reason],
-    )
 
-    _commit()
+async def blacklist_add_async(word, user, reason):
+    """Add a word to the blacklist without writing on the event loop"""
+    await _write_async(BLACKLIST_ADD, [word, user, reason])
+    _load_blacklist()
 
 
 def blacklist_remove(word):
     """Remove word from the blacklist"""
-    cur = _get_cursor()
+    _write(BLACKLIST_REMOVE, [word])
+    _load_blacklist()
 
-    cur.execute("DELETE FROM blacklist WHERE word=?", [word])
 
-    _commit()
+async def blacklist_remove_async(word):
+    """Remove word from the blacklist without writing on the event loop"""
+    await _write_async(BLACKLIST_REMOVE, [word])
+    _load_blacklist()
 
 
 def ban_add(host, user, reason):
     """Add a host to the ban list"""
-    cur = _get_cursor()
+    _write(BAN_ADD, [host, user, reason])
+    _load_bans()
 
-    cur.execute(
-        "INSERT INTO bans(host, added_by, reason) VALUES (?, ?, ?)",
-        [host, user, reason],
-    )
 
-    _commit()
+async def ban_add_async(host, user, reason):
+    """Add a host to the ban list without writing on the event loop"""
+    await _write_async(BAN_ADD, [host, user, reason])
+    _load_bans()
 
 
 def ban_remove(host):
     """Remove a host from the ban list"""
-    cur = _get_cursor()
+    _write(BAN_REMOVE, [host])
+    _load_bans()
 
-    cur.execute("DELETE FROM bans WHERE host=?", [host])
 
-    _commit()
+async def ban_remove_async(host):
+    """Remove a host from the ban list without writing on the event loop"""
+    await _write_async(BAN_REMOVE, [host])
+    _load_bans()
 
 
-def is_host_banned(host):
-    """Checks whether a given host is banned from using this service"""
-    cur = _get_cursor()
+def _is_host_banned(host):
+    if host in BANNED_HOSTS:
+        return True
 
-    cur.execute("SELECT reason FROM bans WHERE host=?", [host])
+    try:
+        address = ipaddress.ip_address(host)
+    except ValueError:
+        return False
 
-    reason = cur.fetchone()
+    if address.version == 6 and address.ipv4_mapped is not None:
+        if _is_host_banned(str(address.ipv4_mapped)):
+            return True
 
-    return reason is not None
+    value = int(address)
 
+    # One set lookup for every prefix length that has bans
+    for prefixlen, prefixes in BANNED_NETWORKS[address.version].items():
+        if value >> (address.max_prefixlen - prefixlen) in prefixes:
+            return True
 
-def is_string_blacklisted(string):
-    """Checks whether a string contains blacklisted words"""
-    cur = _get_cursor()
+    return False
 
-    cur.execute("SELECT word FROM blacklist")
 
-    words = cur.fetchall()
+@metrics.BAN_CHECK_DURATION.time()
+def is_host_banned(host):
+    """Checks whether a given host is banned from using this service"""
+    return _is_host_banned(host)
 
-    for word in words:
-        word = word[0]
-        if (
-            re.compile(r"\b({0})\b".format(word), flags=re.IGNORECASE).search(string)
-            is not None
-        ):
-            return True
 
-    return False
+@metrics.BLACKLIST_CHECK_DURATION.time()
+def is_string_blacklisted(string):
+    """Checks whether a string contains blacklisted words"""
+    if BLACKLIST_PATTERN is not None and BLACKLIST_PATTERN.search(string):
+        return True
+
+    return any(pattern.search(string) for pattern in BLACKLIST_GROUP_PATTERNS)
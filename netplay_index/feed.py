@@ -0,0 +1,224 @@
+"""Push session list changes over WebSockets"""
+
+from tornado.escape import json_encode
+from tornado.websocket import WebSocketClosedError, WebSocketHandler
+
+from netplay_index.api import get_filters
+from netplay_index.util import get_ip, get_rate_limit_key
+import netplay_index.database as database
+import netplay_index.settings as settings
+import netplay_index.sessions as sessions
+import netplay_index.metrics as metrics
+
+
+class _Group:
+    """Subscribers sharing the same filters
+
+    Each event is matched and encoded once per group, however many
+    subscribers it has."""
+
+    def __init__(self, filters, search):
+        self.filters = filters
+        self.search = search
+        self.members = set()
+        self.matching = set(sessions.find(filters, search))
+        self.snapshot_cache = None
+
+    def matches(self, secret):
+        return bool(sessions.find(self.filters, self.search, among={secret}))
+
+    def snapshot(self):
+        """Return the encoded snapshot of all matching sessions"""
+        if self.snapshot_cache is None or self.snapshot_cache[0] != sessions.generation:
+            message = {
+                "type": "snapshot",
+                "revision": sessions.generation,
+                "sessions": [
+                    sessions.get_entry(secret).to_listed_dict()
+                    for secret in self.matching
+                ],
+            }
+            self.snapshot_cache = (sessions.generation, json_encode(message))
+
+        return self.snapshot_cache[1]
+
+    def event(self, secret, session_id, event):
+        """Return the encoded message for a change, or None if irrelevant"""
+        was_matching = secret in self.matching
+        # Replicas may learn of a session only after it's gone again
+        is_matching = (
+            event != "remove"
+            and sessions.get_entry(secret) is not None
+            and self.matches(secret)
+        )
+
+        if is_matching:
+            self.matching.add(secret)
+        else:
+            self.matching.discard(secret)
+
+        if is_matching:
+            return json_encode(
+                {
+                    "type": "update" if was_matching else "add",
+                    "revision": sessions.generation,
+                    "session": sessions.get_entry(secret).to_listed_dict(),
+                }
+            )
+
+        if was_matching:
+            return json_encode(
+                {"type": "remove", "revision": sessions.generation, "id": session_id}
+            )
+
+        return None
+
+
+# Subscriber groups by their normalized filters
+GROUPS = {}
+
+# Number of open subscriptions by host, see get_rate_limit_key
+HOST_SUBSCRIPTIONS = {}
+
+
+def _on_change(secret, session_id, event):
+    for group in list(GROUPS.values()):
+        message = group.event(secret, session_id, event)
+
+        if message is None:
+            continue
+
+        for subscriber in list(group.members):
+            subscriber.send(message)
+
+
+def group_key(filters, search):
+    """Return the key of the group subscribers with these filters belong to"""
+    search = {field: str(value).casefold() for field, value in search.items()}
+    return (tuple(sorted(filters.items())), tuple(sorted(search.items())))
+
+
+def _subscribe(subscriber, host, filters, search):
+    key = group_key(filters, search)
+    HOST_SUBSCRIPTIONS[host] = HOST_SUBSCRIPTIONS.get(host, 0) + 1
+
+    if not GROUPS:
+        sessions.add_listener(_on_change)
+
+    if key not in GROUPS:
+        GROUPS[key] = _Group(filters, search)
+
+    group = GROUPS[key]
+    group.members.add(subscriber)
+    metrics.FEED_SUBSCRIBER_COUNT.inc()
+
+    return key
+
+
+def _unsubscribe(subscriber, host, key):
+    if HOST_SUBSCRIPTIONS[host] > 1:
+        HOST_SUBSCRIPTIONS[host] -= 1
+    else:
+        del HOST_SUBSCRIPTIONS[host]
+
+    group = GROUPS[key]
+    group.members.discard(subscriber)
+    metrics.FEED_SUBSCRIBER_COUNT.dec()
+
+    if not group.members:
+        del GROUPS[key]
+
+    if not GROUPS:
+        sessions.remove_listener(_on_change)
+
+
+# pylint: disable=W0223
+class Handler(WebSocketHandler):
+    """Sends a snapshot of matching sessions followed by their changes"""
+
+    def initialize(self):
+        self.host = None
+        self.key = None
+        self.filters = None
+        self.search = None
+        # Messages written but not yet flushed to the socket
+        self.pending = 0
+        # Whether messages were skipped and a new snapshot is due
+        self.stale = False
+
+    def prepare(self):
+        """Reject bad subscriptions before upgrading the connection"""
+        if int(self.path_kwargs["api_version"]) != 0:
+            self.set_status(400)
+            self.finish({"status": "BAD_VERSION"})
+            return
+
+        if database.is_host_banned(get_ip(self)):
+            self.set_status(403)
+            self.finish({"status": "HOST_BANNED"})
+            return
+
+        try:
+            self.filters, self.search = get_filters(self)
+        except ValueError:
+            self.set_status(400)
+            self.finish({"status": "PARSE_ERROR"})
+            return
+
+        # Every subscription costs memory, and every group work per change
+        self.host = get_rate_limit_key(get_ip(self))
+
+        if (
+            HOST_SUBSCRIPTIONS.get(self.host, 0)
+            >= settings.FEED_MAX_SUBSCRIPTIONS_PER_HOST
+        ):
+            self.set_status(429)
+            self.finish({"status": "TOO_MANY_SUBSCRIPTIONS"})
+            return
+
+        if (
+            group_key(self.filters, self.search) not in GROUPS
+            and len(GROUPS) >= settings.FEED_MAX_GROUPS
+        ):
+            self.set_status(503)
+            self.finish({"status": "TOO_MANY_GROUPS"})
+
+    def open(self, api_version):
+        # pylint: disable=W0221
+        self.key = _subscribe(self, self.host, self.filters, self.search)
+        self.send(GROUPS[self.key].snapshot())
+
+    def on_close(self):
+        if self.key is not None:
+            _unsubscribe(self, self.host, self.key)
+            self.key = None
+
+    def send(self, message):
+        """Send message unless the client can't keep up
+
+        Clients which fall too far behind get no further events until their
+        backlog is flushed, then a fresh snapshot to resynchronize."""
+        if self.stale:
+            return
+
+        if self.pending >= settings.FEED_MAX_PENDING_MESSAGES:
+            self.stale = True
+            return
+
+        try:
+            future = self.write_message(message)
+        except WebSocketClosedError:
+            return
+
+        self.pending += 1
+        future.add_done_callback(self._on_written)
+
+    def _on_written(self, future):
+        self.pending -= 1
+
+        if future.exception() is not None:
+            return
+
+        if self.stale and self.pending == 0 and self.key is not None:
+            self.stale = False
+            self.send(GROUPS[self.key].snapshot())
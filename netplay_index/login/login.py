@@ -1,12 +1,17 @@
 """Handle login logic"""
 
-import time
+import math
 
+from tornado import gen
 from tornado.web import RequestHandler
 
+from netplay_index.util import TokenBuckets, get_ip
 import netplay_index.database as database
 import netplay_index.settings as settings
 
+# Failed login attempts, by IP and by username
+LOGIN_FAILURES = TokenBuckets(settings.LOGIN_FAILURE_MAX_ENTRIES)
+
 # pylint: disable=W0223
 class Logout(RequestHandler):
     """Logout handler"""
@@ -30,15 +35,42 @@ class Login(RequestHandler):
 
         self.render("login.html", ajax=False)
 
-    def post(self):
+    async def post(self):
         """Handle login attempts"""
 
         username = self.get_argument("username", default=None, strip=True)
         password = self.get_argument("password", default=None, strip=True)
 
-        time.sleep(settings.LOGIN_ATTEMPT_DELAY)
+        keys = [("ip", get_ip(self)), ("username", username)]
+        rate, burst = settings.LOGIN_FAILURE_LIMIT
+
+        # Attempts are counted as failures until they succeed, so parallel
+        # attempts can't all get in before the first one fails
+        waits = [LOGIN_FAILURES.take(key, rate, burst) for key in keys]
+        wait = max(waits)
+
+        if wait:
+            for key, key_wait in zip(keys, waits):
+                if not key_wait:
+                    LOGIN_FAILURES.refund(key, burst)
+
+            self.set_header("Retry-After", str(math.ceil(wait)))
+            self.set_status(429)
+            self.render(
+                "login.html", error="Too many failed attempts, try later.", ajax=False
+            )
+            return
+
+        await gen.sleep(settings.LOGIN_ATTEMPT_DELAY)
+
+        if (
+            username
+            and password
+            and await database.check_login_async(username, password)
+        ):
+            for key in keys:
+                LOGIN_FAILURES.refund(key, burst)
 
-        if database.check_login(username, password):
             self.set_secure_cookie("logged_in", username)
             view = self.get_argument("view", default="overview", strip=True)
             self.redirect("/admin/" + view)
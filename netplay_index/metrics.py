@@ -1,8 +1,17 @@
 """Provides metrics via prometheus_client"""
 
+import glob
+import gzip
+import os
+import time
+
 from tornado.web import RequestHandler
 
 import prometheus_client
+from prometheus_client.core import CounterMetricFamily, GaugeMetricFamily
+from prometheus_client.multiprocess import MultiProcessCollector, mark_process_dead
+
+import netplay_index.settings as settings
 
 API_REQUEST_COUNT = prometheus_client.Counter(
     "api_request_count", "Number of requests sent to the API"
@@ -11,16 +20,279 @@ API_SESSION_COUNT = prometheus_client.Counter(
     "api_session_count", "Number of sessions added to the index"
 )
 API_ACTIVE_SESSION_COUNT = prometheus_client.Gauge(
-    "api_active_session_count", "Number of sessions currently on the index"
+    "api_active_session_count",
+    "Number of sessions currently on the index",
+    multiprocess_mode="livesum",
+)
+API_THROTTLED_REQUEST_COUNT = prometheus_client.Counter(
+    "api_throttled_request_count",
+    "Number of API requests rejected for exceeding their rate limit",
+    ["action"],
+)
+FEED_SUBSCRIBER_COUNT = prometheus_client.Gauge(
+    "feed_subscriber_count",
+    "Number of clients subscribed to the session feed",
+    multiprocess_mode="livesum",
+)
+API_REQUEST_LATENCY = prometheus_client.Histogram(
+    "api_request_latency_seconds",
+    "Time taken to answer API requests",
+    ["action", "status"],
+)
+API_LIST_RESULT_SIZE = prometheus_client.Histogram(
+    "api_list_result_size",
+    "Number of sessions returned by /list",
+    buckets=(0, 1, 5, 10, 25, 50, 100, 250, 500, 1000, 2500, 5000, float("inf")),
+)
+
+# Checks done for every request take microseconds, not milliseconds
+FAST_BUCKETS = (
+    0.000001,
+    0.000005,
+    0.00001,
+    0.00005,
+    0.0001,
+    0.0005,
+    0.001,
+    0.005,
+    0.01,
+    float("inf"),
+)
+
+SESSION_CLEANUP_DURATION = prometheus_client.Histogram(
+    "session_cleanup_duration_seconds",
+    "Time taken to remove timed-out sessions",
+)
+BLACKLIST_CHECK_DURATION = prometheus_client.Histogram(
+    "blacklist_check_duration_seconds",
+    "Time taken to check strings against the blacklist",
+    buckets=FAST_BUCKETS,
+)
+BAN_CHECK_DURATION = prometheus_client.Histogram(
+    "ban_check_duration_seconds",
+    "Time taken to check whether hosts are banned",
+    buckets=FAST_BUCKETS,
+)
+GEOIP_LOOKUP_DURATION = prometheus_client.Histogram(
+    "geoip_lookup_duration_seconds",
+    "Time taken to look up the country of IPs",
+    buckets=FAST_BUCKETS,
+)
+GEOIP_CACHE_HIT_COUNT = prometheus_client.Counter(
+    "geoip_cache_hit_count", "Number of GeoIP lookups answered from the cache"
+)
+GEOIP_CACHE_MISS_COUNT = prometheus_client.Counter(
+    "geoip_cache_miss_count", "Number of GeoIP lookups that hit the database"
+)
+
+
+class SpaceSaving:
+    """Approximate counts of the most frequent values in a stream
+
+    Keeps at most capacity values. Counts are never too low and too high by at
+    most the value's error, which is at most total / capacity. Any value
+    counted more often than that is guaranteed to be kept. A capacity of None
+    counts every value exactly."""
+
+    def __init__(self, capacity):
+        self.capacity = capacity
+        # [count, error] by value
+        self.counters = {}
+        self.total = 0
+
+    def add(self, value):
+        """Count value, returning the value it replaced if any"""
+        self.total += 1
+
+        counter = self.counters.get(value)
+        if counter is not None:
+            counter[0] += 1
+            return None
+
+        if self.capacity is None or len(self.counters) < self.capacity:
+            self.counters[value] = [1, 0]
+            return None
+
+        # The newcomer may have been counted as often as the value it replaces
+        evicted = min(self.counters, key=lambda key: self.counters[key][0])
+        count = self.counters.pop(evicted)[0]
+        self.counters[value] = [count + 1, count]
+
+        return evicted
+
+    def __contains__(self, value):
+        return value in self.counters
+
+    def __len__(self):
+        return len(self.counters)
+
+
+class SessionDetails:
+    """Counts sessions by details, folding uncommon games and versions into
+    "other" so the number of time series stays bounded"""
+
+    # Positions of the folded fields in the label values
+    GAME = 0
+    VERSION = 3
+
+    def __init__(self, top_games, top_versions):
+        self.sketches = {
+            self.GAME: SpaceSaving(top_games),
+            self.VERSION: SpaceSaving(top_versions),
+        }
+        self.counts = {}
+        # Label values containing each game and version
+        self.labels = {self.GAME: {}, self.VERSION: {}}
+
+    def _fold(self, field, value):
+        """Count value, moving the counts of the value it replaced to other"""
+        evicted = self.sketches[field].add(value)
+
+        if evicted is None:
+            return
+
+        for labels in self.labels[field].pop(evicted, ()):
+            count = self.counts.pop(labels)
+            for other_field in self.labels:
+                if other_field != field:
+                    self.labels[other_field][labels[other_field]].discard(labels)
+
+            folded = list(labels)
+            folded[field] = "other"
+            self._count(tuple(folded), count)
+
+    def _count(self, labels, count):
+        if labels not in self.counts:
+            self.counts[labels] = 0
+            for field, by_value in self.labels.items():
+                by_value.setdefault(labels[field], set()).add(labels)
+
+        self.counts[labels] += count
+
+    def inc(self, game, password, method, version):
+        """Count a new session"""
+        self._fold(self.GAME, game)
+        self._fold(self.VERSION, version)
+        self._count((game, str(password), method, version), 1)
+
+    def collect(self):
+        """Collect metrics for prometheus_client"""
+        counts = CounterMetricFamily(
+            "api_session_details_count",
+            "Details on sessions added to the index",
+            labels=["game", "password", "method", "version"],
+        )
+        for labels, count in self.counts.items():
+            counts.add_metric(labels, count)
+
+        top = GaugeMetricFamily(
+            "api_session_details_top_count",
+            "Estimated number of sessions of the most common games and versions",
+            labels=["field", "value"],
+        )
+        error = GaugeMetricFamily(
+            "api_session_details_top_error",
+            "How much the estimated number of sessions may be too high",
+            labels=["field", "value"],
+        )
+        for field, name in [(self.GAME, "game"), (self.VERSION, "version")]:
+            for value, (count, value_error) in self.sketches[field].counters.items():
+                top.add_metric([name, value], count)
+                error.add_metric([name, value], value_error)
+
+        return [counts, top, error]
+
+
+API_SESSION_DETAILS_COUNT = SessionDetails(
+    settings.SESSION_DETAILS_TOP_GAMES, settings.SESSION_DETAILS_TOP_VERSIONS
 )
-API_SESSION_DETAILS_COUNT = prometheus_client.Counter(
-    "api_session_details_count",
-    "Details on sessions added to the index",
-    ["game", "password", "method", "version"],
+prometheus_client.REGISTRY.register(API_SESSION_DETAILS_COUNT)
+
+# Where worker processes share their metrics, None if there's only one. Has
+# to be set in the environment before prometheus_client is imported.
+MULTIPROCESS_DIRECTORY = os.environ.get("PROMETHEUS_MULTIPROC_DIR") or os.environ.get(
+    "prometheus_multiproc_dir"
 )
 
 
+def clear_multiprocess_directory():
+    """Remove what workers of an earlier run left in MULTIPROCESS_DIRECTORY"""
+    if not MULTIPROCESS_DIRECTORY:
+        return
+
+    for path in glob.glob(os.path.join(MULTIPROCESS_DIRECTORY, "*.db")):
+        os.remove(path)
+
+
+def mark_dead_processes():
+    """Stop counting the live gauges of workers that died, e.g. ones that were
+    restarted"""
+    if not MULTIPROCESS_DIRECTORY:
+        return
+
+    for path in glob.glob(os.path.join(MULTIPROCESS_DIRECTORY, "gauge_live*.db")):
+        pid = int(os.path.basename(path)[: -len(".db")].rsplit("_", 1)[1])
+
+        try:
+            os.kill(pid, 0)
+        except ProcessLookupError:
+            mark_process_dead(pid, MULTIPROCESS_DIRECTORY)
+        except PermissionError:
+            pass
+
+
+# Registry that is scraped, created on first use
+SCRAPE_REGISTRY = None
+
+# Last exposition as (time rendered, exposition, gzipped exposition)
+EXPOSITION = None
+
+
+def _get_scrape_registry():
+    """Return a registry with the metrics of all worker processes"""
+
+    # pylint: disable=W0603
+    global SCRAPE_REGISTRY
+
+    if SCRAPE_REGISTRY is not None:
+        return SCRAPE_REGISTRY
+
+    if MULTIPROCESS_DIRECTORY:
+        SCRAPE_REGISTRY = prometheus_client.CollectorRegistry()
+        MultiProcessCollector(SCRAPE_REGISTRY, MULTIPROCESS_DIRECTORY)
+        # Kept in memory by the process owning the sessions, which is scraped
+        SCRAPE_REGISTRY.register(API_SESSION_DETAILS_COUNT)
+    else:
+        SCRAPE_REGISTRY = prometheus_client.REGISTRY
+
+    return SCRAPE_REGISTRY
+
+
+def get_exposition():
+    """Return the rendered metrics and their gzipped version, rendering them at
+    most every METRICS_CACHE_TTL seconds"""
+
+    # pylint: disable=W0603
+    global EXPOSITION
+
+    now = time.monotonic()
+
+    if EXPOSITION is None or now - EXPOSITION[0] >= settings.METRICS_CACHE_TTL:
+        exposition = prometheus_client.generate_latest(_get_scrape_registry())
+        EXPOSITION = (now, exposition, gzip.compress(exposition, 6))
+
+    return EXPOSITION[1:]
+
+
 class MetricsHandler(RequestHandler):
     def get(self):
-        self.write(prometheus_client.generate_latest())
+        exposition, compressed = get_exposition()
+
         self.set_header("Content-Type", prometheus_client.CONTENT_TYPE_LATEST)
+        self.set_header("Vary", "Accept-Encoding")
+
+        if "gzip" in self.request.headers.get("Accept-Encoding", ""):
+            self.set_header("Content-Encoding", "gzip")
+            self.write(compressed)
+        else:
+            self.write(exposition)
@@ -0,0 +1,105 @@
+"""Sample where the event loop spends its time, for flamegraphs
+
+Nothing runs unless a profile was started. While it runs, a thread looks at
+the event loop's stack every PROFILER_INTERVAL seconds."""
+
+from collections import Counter
+import os
+import sys
+import threading
+import time
+
+import netplay_index.settings as settings
+
+# The running or last profile, None if there never was one
+PROFILE = None
+
+
+def _describe(code):
+    """Describe where code is, e.g. 'get (tornado/web.py:123)'"""
+    path = code.co_filename.split(os.sep)
+    return "{} ({}:{})".format(code.co_name, "/".join(path[-2:]), code.co_firstlineno)
+
+
+class Profile:
+    """Stacks of a thread, sampled for some time"""
+
+    def __init__(self, thread_id, duration):
+        self.thread_id = thread_id
+        self.duration = duration
+        self.started = time.time()
+        self.finished = None
+        # Number of samples, by stack from the outermost function in
+        self.stacks = Counter()
+        self.samples = 0
+        self.descriptions = {}
+
+    def _sample(self):
+        # pylint: disable=W0212
+        frame = sys._current_frames().get(self.thread_id)
+        stack = []
+
+        while frame is not None:
+            code = frame.f_code
+            description = self.descriptions.get(code)
+            if description is None:
+                description = self.descriptions[code] = _describe(code)
+            stack.append(description)
+            frame = frame.f_back
+
+        stack.reverse()
+        self.stacks[tuple(stack)] += 1
+        self.samples += 1
+
+    def run(self):
+        """Sample until duration is over"""
+        deadline = time.monotonic() + self.duration
+
+        try:
+            while time.monotonic() < deadline:
+                self._sample()
+                time.sleep(settings.PROFILER_INTERVAL)
+        finally:
+            self.finished = time.time()
+
+    def collapsed(self):
+        """Return the stacks in the collapsed format read by flamegraph.pl"""
+        return "".join(
+            "{} {}\n".format(";".join(stack), count)
+            for stack, count in sorted(self.stacks.items())
+        )
+
+    def top_functions(self, limit=20):
+        """Return the functions most samples were in as (function, samples in
+        the function itself, samples in it or functions it called)"""
+        own = Counter()
+        total = Counter()
+
+        for stack, count in self.stacks.items():
+            if stack:
+                own[stack[-1]] += count
+            # Recursive functions only count once per sample
+            for function in set(stack):
+                total[function] += count
+
+        return [
+            (function, samples, total[function])
+            for function, samples in own.most_common(limit)
+        ]
+
+
+def start(duration):
+    """Profile the calling thread for duration seconds in the background
+
+    Returns False if a profile is running already."""
+
+    # pylint: disable=W0603
+    global PROFILE
+
+    if PROFILE is not None and PROFILE.finished is None:
+        return False
+
+    PROFILE = Profile(threading.get_ident(), duration)
+    threading.Thread(target=PROFILE.run, name="profiler", daemon=True).start()
+
+    return True
@@ -0,0 +1,206 @@
+"""Share the session table between worker processes
+
+One process owns the sessions and makes every change to them. The others
+serve lists from a replica they keep up to date by polling the owner, and
+forward all other requests to it."""
+
+import hmac
+import itertools
+import marshal
+import os
+import secrets
+
+from tornado import gen
+from tornado.httpclient import AsyncHTTPClient, HTTPRequest
+from tornado.ioloop import IOLoop
+from tornado.log import access_log, app_log
+from tornado.web import RequestHandler
+
+from netplay_index.util import get_ip
+import netplay_index.database as database
+import netplay_index.settings as settings
+import netplay_index.sessions as sessions
+
+# Shared by all workers as they are forked, guards the owner's sessions
+TOKEN = secrets.token_urlsafe()
+
+# State of the owner as of the last replication
+owner_epoch = None
+owner_bans_revision = None
+
+
+def _epoch():
+    # Restarted owners are forked off the same parent, so only their process ID
+    # tells them apart
+    return str(os.getpid())
+
+
+def changes_after(revision, epoch):
+    """Return (changes, records, reset) bringing a replica at revision up to date"""
+    if epoch == _epoch() and revision == sessions.generation:
+        return [], {}, False
+
+    if (
+        epoch != _epoch()
+        or revision > sessions.generation
+        or not sessions.CHANGES
+        or sessions.CHANGES[0][0] > revision + 1
+    ):
+        records = {secret: sessions.get_record(secret) for secret in sessions.SESSIONS}
+        return [], records, True
+
+    changes = list(
+        itertools.takewhile(
+            lambda change: change[0] > revision, reversed(sessions.CHANGES)
+        )
+    )
+    changes.reverse()
+
+    records = {}
+    for _, secret, _, _ in changes:
+        if secret not in records:
+            records[secret] = (
+                sessions.get_record(secret) if secret in sessions.SESSIONS else None
+            )
+
+    return changes, records, False
+
+
+async def _replicate(owner):
+    # pylint: disable=W0603
+    global owner_epoch, owner_bans_revision
+
+    request = HTTPRequest(
+        "{}/replicate?since={}&epoch={}".format(
+            owner, sessions.generation, owner_epoch
+        ),
+        headers={"X-Replication-Token": TOKEN},
+    )
+
+    try:
+        response = await AsyncHTTPClient().fetch(request)
+    except Exception as e:  # pylint: disable=W0703
+        # The owner may just be restarting
+        app_log.warning("Failed to replicate sessions: %s", e)
+        return
+
+    epoch, revision, changes, records, reset, bans_revision = marshal.loads(
+        response.body
+    )
+
+    sessions.replicate(revision, changes, records, reset=reset)
+    owner_epoch = epoch
+
+    if bans_revision != owner_bans_revision:
+        database.reload_bans()
+        owner_bans_revision = bans_revision
+
+
+async def _replicate_forever(owner):
+    while True:
+        await _replicate(owner)
+        await gen.sleep(settings.REPLICATION_DELAY)
+
+
+def start_replication(owner):
+    """Keep the sessions of this process in sync with those of owner"""
+    IOLoop.current().spawn_callback(_replicate_forever, owner)
+
+
+def log_request(handler):
+    """Log polls of replicas at debug level, as they come several times a
+    second, and rejected ones as warnings"""
+    # pylint: disable=W0212
+    log = access_log.debug if handler.get_status() < 400 else access_log.warning
+    log(
+        "%d %s %.2fms",
+        handler.get_status(),
+        handler._request_summary(),
+        1000.0 * handler.request.request_time(),
+    )
+
+
+# pylint: disable=W0223
+class ReplicateHandler(RequestHandler):
+    """Sends sessions changed since a revision to replicas
+
+    Only served on the owner's loopback socket, as it includes host IPs."""
+
+    def get(self):
+        token = self.request.headers.get("X-Replication-Token", "")
+
+        if not hmac.compare_digest(token, TOKEN):
+            self.set_status(403)
+            return
+
+        try:
+            since = int(self.get_argument("since"))
+        except ValueError:
+            self.set_status(400)
+            return
+
+        epoch = self.get_argument("epoch")
+        changes, records, reset = changes_after(since, epoch)
+
+        self.set_header("Content-Type", "application/octet-stream")
+        self.write(
+            marshal.dumps(
+                (
+                    _epoch(),
+                    sessions.generation,
+                    changes,
+                    records,
+                    reset,
+                    database.BANS_REVISION,
+                )
+            )
+        )
+
+
+# pylint: disable=W0223
+class ProxyHandler(RequestHandler):
+    """Forwards requests to the owner of the sessions"""
+
+    def initialize(self, owner):
+        # pylint: disable=W0201
+        self.owner = owner
+
+    def check_xsrf_cookie(self):
+        """Left to the owner, which gets the same cookies"""
+
+    async def get(self):
+        await self._forward()
+
+    async def post(self):
+        await self._forward()
+
+    async def _forward(self):
+        headers = self.request.headers.copy()
+        headers["X-Real-IP"] = get_ip(self)
+
+        request = HTTPRequest(
+            self.owner + self.request.uri,
+            method=self.request.method,
+            headers=headers,
+            body=self.request.body if self.request.method == "POST" else None,
+            follow_redirects=False,
+            decompress_response=False,
+        )
+
+        response = await AsyncHTTPClient().fetch(request, raise_error=False)
+
+        if response.code == 599:
+            self.set_status(502)
+            return
+
+        self.set_status(response.code, response.reason)
+
+        for name in ["Content-Type", "Date", "Server"]:
+            self.clear_header(name)
+
+        for name, value in response.headers.get_all():
+            if name not in ["Connection", "Content-Length", "Transfer-Encoding"]:
+                self.add_header(name, value)
+
+        if response.body:
+            self.write(response.body)
@@ -1,18 +1,270 @@
 """Handle sessions"""
 
+from collections import deque
+from collections.abc import Mapping
+import bisect
+import heapq
+import ipaddress
+import operator
 import time
 
 from netplay_index.util import generate_secret, get_ip_region
 import netplay_index.metrics as metrics
+import netplay_index.settings as settings
+
+# Fields every session has, in the order they are listed in
+FIELDS = (
+    "id",
+    "name",
+    "region",
+    "game",
+    "server_id",
+    "port",
+    "player_count",
+    "in_game",
+    "password",
+    "version",
+    "method",
+    "timestamp",
+)
+
+# Fields whose values tend to repeat between sessions. Sessions share a single
+# copy of each of their values, see _intern.
+INTERNED_FIELDS = ["region", "game", "version", "method"]
+
+# Shared copies of strings in use by sessions as [string, reference count]
+INTERNED = {}
+
+# Fields sent to clients. Heartbeats only change the timestamp and don't make
+# a new revision, so it's left out for a revision to always be listed the same.
+LISTED_FIELDS = tuple(field for field in FIELDS if field != "timestamp")
+
+_get_fields = operator.attrgetter(*FIELDS)
+_get_listed_fields = operator.attrgetter(*LISTED_FIELDS)
+
+
+def _intern(string):
+    entry = INTERNED.get(string)
+
+    if entry is None:
+        entry = INTERNED[string] = [string, 0]
+
+    entry[1] += 1
+    return entry[0]
+
+
+def _release(string):
+    entry = INTERNED[string]
+    entry[1] -= 1
+
+    if not entry[1]:
+        del INTERNED[string]
+
+
+def _pack_host(host):
+    try:
+        return ipaddress.ip_address(host).packed
+    except ValueError:
+        return host
+
+
+def _unpack_host(packed_host):
+    if isinstance(packed_host, bytes):
+        return str(ipaddress.ip_address(packed_host))
+
+    return packed_host
+
+
+# pylint: disable=R0902
+class Session(Mapping):
+    """A session on the index, readable like a dict of its FIELDS"""
+
+    __slots__ = FIELDS + ("packed_host", "country", "folded_name", "folded_game")
+
+    def __init__(self, session_id, fields, host, country):
+        for field in FIELDS[1:]:
+            value = fields[field]
+            if field in INTERNED_FIELDS:
+                value = _intern(value)
+            setattr(self, field, value)
+
+        self.id = session_id
+        self.packed_host = _pack_host(host)
+        self.country = None if country is None else _intern(country)
+        self.folded_name = str(self.name).casefold()
+        self.folded_game = _intern(str(self.game).casefold())
+
+    def release(self):
+        """Give back the shared copies of this session's values"""
+        for field in INTERNED_FIELDS:
+            _release(getattr(self, field))
+
+        if self.country is not None:
+            _release(self.country)
+
+        _release(self.folded_game)
+
+    @property
+    def host(self):
+        """Host as string"""
+        return _unpack_host(self.packed_host)
+
+    def to_dict(self):
+        """Return FIELDS as a dict"""
+        return dict(zip(FIELDS, _get_fields(self)))
+
+    def to_listed_dict(self):
+        """Return LISTED_FIELDS as a dict, for JSON encoding in responses"""
+        return dict(zip(LISTED_FIELDS, _get_listed_fields(self)))
+
+    def __getitem__(self, field):
+        if field not in FIELDS:
+            raise KeyError(field)
+
+        return getattr(self, field)
+
+    def __iter__(self):
+        return iter(FIELDS)
+
+    def __len__(self):
+        return len(FIELDS)
+
+
+class _AttributeView(Mapping):
+    """Read-only mapping of secrets to an attribute of their sessions"""
+
+    def __init__(self, attribute):
+        self.attribute = attribute
+
+    def __getitem__(self, secret):
+        return getattr(SESSIONS[secret], self.attribute)
+
+    def __iter__(self):
+        return iter(SESSIONS)
+
+    def __len__(self):
+        return len(SESSIONS)
+
 
 SESSIONS = {}
-HOSTS = {}
-REGIONS = {}
+HOSTS = _AttributeView("host")
+REGIONS = _AttributeView("country")
+
+# Maps every packed host to the set of secrets of its sessions
+HOST_SESSIONS = {}
+
+# Heap of (timestamp, secret) pairs ordered by last heartbeat. Heartbeats push a
+# new pair instead of updating the old one, outdated pairs are skipped when
+# they reach the top.
+EXPIRY_QUEUE = []
+
+# Fields that can be filtered on by exact value. For each of them, INDEXES maps
+# every value in use to the set of secrets of the sessions having it.
+INDEXED_FIELDS = ["region", "version", "password", "in_game"]
+INDEXES = {field: {} for field in INDEXED_FIELDS}
+
+# Fields that can be searched for substrings, ignoring case. Sessions keep
+# their case-folded values in the attributes named by FOLDED, TRIGRAMS maps
+# every three character sequence occurring in them to the set of secrets of the
+# sessions containing it.
+SEARCHABLE_FIELDS = ["name", "game"]
+FOLDED = {"name": "folded_name", "game": "folded_game"}
+TRIGRAMS = {field: {} for field in SEARCHABLE_FIELDS}
+
+# Orders sessions can be listed in. ORDERED holds all sessions sorted by each of
+# them as (value, id, secret) tuples, the id making every position unique.
+ORDERS = ["player_count", "name", "game", "age"]
+ORDERED = {order: [] for order in ORDERS}
 
 
 start_time = time.asctime(time.localtime())
 total_session_count = 0
 
+# Bumped whenever a session is added, removed or has a listed field changed.
+# Heartbeats that only refresh the timestamp don't count as a change.
+generation = 0
+
+# The most recent changes as (generation, secret, id, event) tuples, oldest
+# first. event is one of "add", "update" or "remove".
+CHANGES = deque(maxlen=settings.SESSION_CHANGELOG_SIZE)
+
+# Callbacks invoked with (secret, id, event) whenever a session changes
+LISTENERS = []
+
+
+def _index(field, value, secret):
+    INDEXES[field].setdefault(value, set()).add(secret)
+
+
+def _unindex(field, value, secret):
+    index = INDEXES[field]
+    secrets = index[value]
+    secrets.discard(secret)
+
+    if not secrets:
+        del index[value]
+
+
+def _trigrams(string):
+    return {string[i : i + 3] for i in range(len(string) - 2)}
+
+
+def _index_text(field, session, secret):
+    trigrams = TRIGRAMS[field]
+    for trigram in _trigrams(getattr(session, FOLDED[field])):
+        trigrams.setdefault(trigram, set()).add(secret)
+
+
+def _unindex_text(field, session, secret):
+    trigrams = TRIGRAMS[field]
+    for trigram in _trigrams(getattr(session, FOLDED[field])):
+        secrets = trigrams[trigram]
+        secrets.discard(secret)
+
+        if not secrets:
+            del trigrams[trigram]
+
+
+def _order_value(order, session):
+    if order == "age":
+        # Youngest first
+        return -session.id
+
+    if order in FOLDED:
+        return getattr(session, FOLDED[order])
+
+    return getattr(session, order)
+
+
+def _insert_ordered(order, session, secret):
+    entry = (_order_value(order, session), session.id, secret)
+    bisect.insort(ORDERED[order], entry)
+
+
+def _remove_ordered(order, session, secret):
+    entries = ORDERED[order]
+    entry = (_order_value(order, session), session.id, secret)
+    del entries[bisect.bisect_left(entries, entry)]
+
+
+def _changed(secret, session_id, event):
+    # pylint: disable=W0603
+    global generation
+
+    generation += 1
+    CHANGES.append((generation, secret, session_id, event))
+
+    for listener in LISTENERS:
+        listener(secret, session_id, event)
+
+
+def add_listener(listener):
+    LISTENERS.append(listener)
+
+
+def remove_listener(listener):
+    LISTENERS.remove(listener)
+
 
 def get_all():
     return SESSIONS
@@ -28,35 +280,367 @@ def get_entry(secret):
     return SESSIONS[secret]
 
 
+def _insert(secret, session, expires=True):
+    """Add a session, which remove_expired looks after unless expires is False"""
+    SESSIONS[secret] = session
+    HOST_SESSIONS.setdefault(session.packed_host, set()).add(secret)
+
+    for field in INDEXED_FIELDS:
+        _index(field, getattr(session, field), secret)
+
+    for field in SEARCHABLE_FIELDS:
+        _index_text(field, session, secret)
+
+    for order in ORDERS:
+        _insert_ordered(order, session, secret)
+
+    if expires:
+        heapq.heappush(EXPIRY_QUEUE, (session.timestamp, secret))
+
+
+def _update(secret, fields, expires=True):
+    """Update fields of a session, returning whether more than its timestamp changed"""
+    session = SESSIONS[secret]
+    changed = False
+
+    for field, value in fields.items():
+        old_value = getattr(session, field)
+
+        if old_value == value:
+            continue
+
+        if field in INDEXES:
+            _unindex(field, old_value, secret)
+            _index(field, value, secret)
+
+        if field in FOLDED:
+            _unindex_text(field, session, secret)
+
+        if field in ORDERED:
+            _remove_ordered(field, session, secret)
+
+        if field in INTERNED_FIELDS:
+            _release(old_value)
+            value = _intern(value)
+
+        setattr(session, field, value)
+
+        if field == "name":
+            session.folded_name = str(value).casefold()
+
+        if field == "game":
+            _release(session.folded_game)
+            session.folded_game = _intern(str(value).casefold())
+
+        if field in FOLDED:
+            _index_text(field, session, secret)
+
+        if field in ORDERED:
+            _insert_ordered(field, session, secret)
+
+        changed = changed or field != "timestamp"
+
+    if expires and "timestamp" in fields:
+        heapq.heappush(EXPIRY_QUEUE, (session.timestamp, secret))
+
+    return changed
+
+
+def _delete(secret):
+    session = SESSIONS.pop(secret)
+
+    host_sessions = HOST_SESSIONS[session.packed_host]
+    host_sessions.discard(secret)
+    if not host_sessions:
+        del HOST_SESSIONS[session.packed_host]
+
+    for field in INDEXED_FIELDS:
+        _unindex(field, getattr(session, field), secret)
+
+    for field in SEARCHABLE_FIELDS:
+        _unindex_text(field, session, secret)
+
+    for order in ORDERS:
+        _remove_ordered(order, session, secret)
+
+    session.release()
+
+    return session
+
+
 def add_entry(session, host):
     global total_session_count
 
     secret = generate_secret()
-    SESSIONS[secret] = session
-    HOSTS[secret] = host
-    REGIONS[secret] = get_ip_region(host)
     total_session_count += 1
+    session = Session(total_session_count, session, host, get_ip_region(host))
+    _insert(secret, session)
+    _changed(secret, session.id, "add")
 
     metrics.API_SESSION_COUNT.inc()
     metrics.API_ACTIVE_SESSION_COUNT.inc()
-    metrics.API_SESSION_DETAILS_COUNT.labels(
-        game=session["game"],
-        password=session["password"],
-        method=session["method"],
-        version=session["version"],
-    ).inc()
+    metrics.API_SESSION_DETAILS_COUNT.inc(
+        game=session.game,
+        password=session.password,
+        method=session.method,
+        version=session.version,
+    )
 
     return secret
 
 
+def update_entry(secret, **fields):
+    """Update fields of an existing session"""
+    if _update(secret, fields):
+        _changed(secret, SESSIONS[secret].id, "update")
+
+
 def remove_entry(secret):
-    del SESSIONS[secret]
-    del HOSTS[secret]
-    del REGIONS[secret]
+    session = _delete(secret)
+    _changed(secret, session.id, "remove")
 
     metrics.API_ACTIVE_SESSION_COUNT.dec()
 
 
+def remove_expired(deadline):
+    """Remove all sessions whose last heartbeat happened before deadline"""
+    removed = 0
+
+    while EXPIRY_QUEUE and EXPIRY_QUEUE[0][0] < deadline:
+        timestamp, secret = heapq.heappop(EXPIRY_QUEUE)
+
+        session = SESSIONS.get(secret)
+        if session is None or session.timestamp != timestamp:
+            continue
+
+        remove_entry(secret)
+        removed += 1
+
+    return removed
+
+
+def get_record(secret):
+    """Return (fields, host, country) of a session, enough to recreate it
+
+    The host is returned packed, as it is stored."""
+    session = SESSIONS[secret]
+    return (_get_fields(session), session.packed_host, session.country)
+
+
+def get_records(secrets):
+    """Return (secret, fields, host, country) for those of secrets still around"""
+    records = []
+
+    for secret in secrets:
+        session = SESSIONS.get(secret)
+        if session is not None:
+            records.append(
+                (secret, _get_fields(session), session.packed_host, session.country)
+            )
+
+    return records
+
+
+def _from_record(record):
+    values, host, country = record
+    return Session(values[0], dict(zip(FIELDS, values)), host, country)
+
+
+def get_state(records=None):
+    """Return everything needed to bring the sessions back after a restart
+
+    records are the get_records of all sessions, if already at hand."""
+    if records is None:
+        records = get_records(SESSIONS)
+
+    return (start_time, total_session_count, generation, records)
+
+
+def restore(state, deadline):
+    """Add the sessions of a get_state which had a heartbeat since deadline
+
+    Meant for startup, the change log starts over. Returns how many sessions
+    were restored."""
+
+    # pylint: disable=W0603
+    global start_time, total_session_count, generation
+
+    saved_start_time, saved_session_count, saved_generation, records = state
+    timestamp = FIELDS.index("timestamp")
+    restored = 0
+
+    for secret, values, host, country in records:
+        if secret in SESSIONS or values[timestamp] < deadline:
+            continue
+
+        _insert(secret, _from_record((values, host, country)))
+        metrics.API_ACTIVE_SESSION_COUNT.inc()
+        restored += 1
+
+    start_time = saved_start_time
+    # Keep ids unique
+    total_session_count = max(total_session_count, saved_session_count)
+    # Neither sessions dropped here nor changes made after the snapshot was
+    # taken are in the change log, so revisions clients got before the restart
+    # must not be found in it. Skipping further than the change log reaches
+    # makes them all fall back to a full list.
+    generation = max(generation, saved_generation) + settings.SESSION_CHANGELOG_SIZE + 1
+    CHANGES.clear()
+
+    return restored
+
+
+def replicate(revision, changes, records, reset=False):
+    """Catch up with the changes another process made to its sessions
+
+    changes are its CHANGES entries after our generation, records the
+    get_record of every changed session, None for removed ones. With reset,
+    sessions missing from records are dropped as well. Expiring sessions is
+    left to the other process, so they aren't queued for it here."""
+
+    # pylint: disable=W0603
+    global generation
+
+    events = [(secret, session_id, event) for _, secret, session_id, event in changes]
+
+    if reset:
+        for secret in list(SESSIONS):
+            if secret not in records:
+                events.append((secret, _delete(secret).id, "remove"))
+
+        events.extend(
+            (secret, record[0][0], "add") for secret, record in records.items()
+        )
+        CHANGES.clear()
+
+    for secret, record in records.items():
+        if record is None:
+            if secret in SESSIONS:
+                _delete(secret)
+        elif secret in SESSIONS:
+            # Hosts and countries never change
+            _update(secret, dict(zip(FIELDS[1:], record[0][1:])), expires=False)
+        else:
+            _insert(secret, _from_record(record), expires=False)
+
+    generation = revision
+    CHANGES.extend(changes)
+
+    for secret, session_id, event in events:
+        for listener in LISTENERS:
+            listener(secret, session_id, event)
+
+
+def changes_since(revision):
+    """Return (id, added) pairs by secret for sessions changed after revision"""
+
+    # added is True for sessions that didn't exist yet at revision. None means
+    # the change log doesn't reach back far enough.
+    if revision == generation:
+        return {}
+
+    if revision > generation or not CHANGES or CHANGES[0][0] > revision + 1:
+        return None
+
+    changes = {}
+
+    for change_generation, secret, session_id, event in reversed(CHANGES):
+        if change_generation <= revision:
+            break
+        # Going backwards, so the earliest change of each session wins
+        changes[secret] = (session_id, event == "add")
+
+    return changes
+
+
+def find(filters, search=None, among=None):
+    """Return the secrets of sessions matching filters and containing search"""
+    search = {field: str(value).casefold() for field, value in (search or {}).items()}
+
+    candidates = [INDEXES[field].get(value, set()) for field, value in filters.items()]
+
+    if among is not None:
+        candidates.append(among)
+
+    for field, value in search.items():
+        trigrams = TRIGRAMS[field]
+        candidates.extend(trigrams.get(trigram, set()) for trigram in _trigrams(value))
+
+    if candidates:
+        candidates.sort(key=len)
+
+        # Intersecting starting from the smallest set keeps every step at most
+        # as expensive as the most selective filter
+        secrets = candidates[0]
+        for other in candidates[1:]:
+            if not secrets:
+                break
+            secrets = secrets.intersection(other)
+    else:
+        secrets = SESSIONS
+
+    if not search:
+        return list(secrets)
+
+    # Sessions containing all trigrams of a string don't necessarily contain
+    # the string itself
+    return [
+        secret
+        for secret in secrets
+        if all(
+            value in getattr(SESSIONS[secret], FOLDED[field])
+            for field, value in search.items()
+        )
+    ]
+
+
+def sort_key(order, secret):
+    """Return the (value, id) position of a session in order"""
+    session = SESSIONS[secret]
+    return (_order_value(order, session), session.id)
+
+
+def sort(order, secrets=None, descending=False, after=None, limit=None):
+    """Return up to limit of secrets in order, starting after a sort_key"""
+    entries = ORDERED[order]
+
+    if secrets is not None:
+        secrets = set(secrets)
+
+        # Sorting few matches directly is cheaper than skipping through all
+        # sessions for them
+        if len(secrets) * 8 < len(entries):
+            entries = sorted(
+                (_order_value(order, SESSIONS[secret]), SESSIONS[secret].id, secret)
+                for secret in secrets
+            )
+            secrets = None
+
+    if descending:
+        end = len(entries) if after is None else bisect.bisect_left(entries, after)
+        indices = range(end - 1, -1, -1)
+    else:
+        # Ids are unique, so (value, id + 1) sorts right after the entry at after
+        start = (
+            0
+            if after is None
+            else bisect.bisect_left(entries, (after[0], after[1] + 1))
+        )
+        indices = range(start, len(entries))
+
+    result = []
+
+    for index in indices:
+        if limit is not None and len(result) == limit:
+            break
+
+        secret = entries[index][2]
+        if secrets is None or secret in secrets:
+            result.append(secret)
+
+    return result
+
+
 def hosts():
     return HOSTS
 
@@ -65,5 +649,9 @@ def regions():
     return REGIONS
 
 
+def get_host_sessions(ip):
+    return HOST_SESSIONS.get(_pack_host(ip), set())
+
+
 def get_host_session_count(ip):
-    return list(HOSTS.values()).count(ip)
+    return len(get_host_sessions(ip))
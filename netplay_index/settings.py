@@ -4,8 +4,8 @@ import os
 
 ## API
 
-# How long until timed-out sessions are cleaned up
-SESSION_CLEANUP_DELAY = 30
+# How often timed-out sessions are cleaned up, in seconds
+SESSION_CLEANUP_DELAY = 1
 
 # How long until sessions time out
 SESSION_TIMEOUT_SECONDS = 15
@@ -19,9 +19,102 @@ SESSION_MAX_STRING_LENGTH = 64
 # The maximum amount of sessions a single host can have simultaneously
 MAXIMUM_SESSIONS_PER_HOST = 5
 
+# Requests per second and burst size allowed per IP, by action. Other
+# actions share the "other" budget. With several workers, each one answers
+# lists with its own limits, so the "list" budget is split between them.
+RATE_LIMITS = {
+    "list": (2, 20),
+    "session/add": (1, 10),
+    "session/active": (5, 25),
+    "session/active_batch": (1, 10),
+    "session/remove": (1, 10),
+    "other": (1, 10),
+}
+
+# Length of the prefix IPv6 addresses share rate limits by
+RATE_LIMIT_IPV6_PREFIX = 64
+
+# How many IP and action pairs to keep rate limits for. Those used least
+# recently are forgotten first.
+RATE_LIMIT_MAX_ENTRIES = 100000
+
+# Where sessions are saved to survive restarts, empty to not save them
+SESSION_SNAPSHOT_PATH = os.environ.get("SESSION_SNAPSHOT_PATH", "sessions.snapshot")
+
+# How often sessions are saved, in seconds. They're also saved on shutdown.
+SESSION_SNAPSHOT_INTERVAL = 30
+
+# How many encoded /list responses to keep around for repeated queries
+LIST_CACHE_SIZE = 64
+
+# The maximum amount of sessions returned per /list page
+LIST_MAX_PAGE_SIZE = 500
+
+# How many session changes to remember for incremental /list requests
+SESSION_CHANGELOG_SIZE = 10000
+
+# How many unsent messages a /feed client may fall behind before it gets
+# resynchronized with a snapshot instead
+FEED_MAX_PENDING_MESSAGES = 64
+
+# How many /feed connections a host may have open at once, per worker
+FEED_MAX_SUBSCRIPTIONS_PER_HOST = 10
+
+# How many different filters /feed clients may subscribe with at once, per
+# worker. Every session change is matched against each of them.
+FEED_MAX_GROUPS = 1000
+
+# How often worker processes poll the owner of the sessions for changes, in
+# seconds
+REPLICATION_DELAY = 0.1
+
+# How many distinct games and versions to report session counts for, the
+# rest are reported as "other". None reports all of them.
+SESSION_DETAILS_TOP_GAMES = 100
+SESSION_DETAILS_TOP_VERSIONS = 20
+
+# How long a rendered /metrics response is reused for, in seconds
+METRICS_CACHE_TTL = 1
+
 GEOIP_DATABASE_PATH = os.environ.get("GEOIP_DATABASE_PATH", "GeoLite2-Country.mmdb")
 
+# How often to check whether the GeoIP database file was updated, in seconds
+GEOIP_RELOAD_CHECK_INTERVAL = 60
+
+# How many IP to country lookups to remember
+GEOIP_CACHE_SIZE = 4096
+
 ## Login
 
 # How long every single login attempt should take in seconds
 LOGIN_ATTEMPT_DELAY = 1
+
+# Failed login attempts allowed per second and in a burst, both per IP and
+# per username
+LOGIN_FAILURE_LIMIT = (1 / 60, 5)
+
+# How many IPs and usernames to remember failed login attempts for
+LOGIN_FAILURE_MAX_ENTRIES = 10000
+
+# How many passwords may be hashed or checked at the same time
+PASSWORD_HASH_THREADS = 2
+
+## Database
+
+# Where users, bans and the blacklist are stored. ":memory:" keeps them in
+# memory only, e.g. for tests.
+DATABASE_PATH = os.environ.get("DATABASE_PATH", "main.db")
+
+# How many compiled SQL statements each connection keeps for reuse
+DATABASE_CACHED_STATEMENTS = 64
+
+# How long to wait for another process to finish writing, in seconds
+DATABASE_BUSY_TIMEOUT = 5
+
+## Profiler
+
+# How often the profiler samples the event loop's stack, in seconds
+PROFILER_INTERVAL = 0.005
+
+# The longest a profile may run, in seconds
+PROFILER_MAX_DURATION = 60
@@ -0,0 +1,108 @@
+"""Keep sessions across restarts by saving them to disk"""
+
+import marshal
+import os
+import time
+import zlib
+
+from tornado import gen
+from tornado.ioloop import IOLoop, PeriodicCallback
+from tornado.log import app_log
+
+import netplay_index.settings as settings
+import netplay_index.sessions as sessions
+
+# Identifies snapshot files and the version of their format
+MAGIC = b"NPISNAP1"
+
+# How many sessions to copy at a time before letting requests through
+CHUNK_SIZE = 5000
+
+# Whether a snapshot is being written in the background right now
+saving = False
+
+
+def _write(path, state):
+    """Encode state and atomically replace path with it"""
+    data = MAGIC + zlib.compress(marshal.dumps(state), 1)
+    temporary_path = path + ".tmp"
+
+    with open(temporary_path, "wb") as snapshot_file:
+        snapshot_file.write(data)
+
+    os.replace(temporary_path, path)
+
+
+def save(path=None):
+    """Save all sessions to path, blocking until done"""
+    _write(path or settings.SESSION_SNAPSHOT_PATH, sessions.get_state())
+
+
+async def save_in_background(path=None):
+    """Save all sessions to path without blocking the event loop for long
+
+    Sessions are copied a chunk at a time on the event loop, encoding and
+    writing them is left to a thread."""
+
+    # pylint: disable=W0603
+    global saving
+
+    if saving:
+        return
+
+    saving = True
+    try:
+        secrets = list(sessions.get_all())
+        records = []
+
+        for start in range(0, len(secrets), CHUNK_SIZE):
+            records.extend(sessions.get_records(secrets[start : start + CHUNK_SIZE]))
+            await gen.sleep(0)
+
+        await IOLoop.current().run_in_executor(
+            None,
+            _write,
+            path or settings.SESSION_SNAPSHOT_PATH,
+            sessions.get_state(records),
+        )
+    except OSError as e:
+        app_log.warning("Failed to save sessions: %s", e)
+    finally:
+        saving = False
+
+
+def load(path=None):
+    """Restore the sessions saved to path, returning how many were restored"""
+    path = path or settings.SESSION_SNAPSHOT_PATH
+
+    try:
+        with open(path, "rb") as snapshot_file:
+            data = snapshot_file.read()
+    except FileNotFoundError:
+        return 0
+
+    if not data.startswith(MAGIC):
+        app_log.warning("Ignoring %s, it's not a session snapshot", path)
+        return 0
+
+    try:
+        state = marshal.loads(zlib.decompress(data[len(MAGIC) :]))
+    except (zlib.error, ValueError, EOFError, TypeError):
+        app_log.warning("Ignoring %s, it's corrupted", path)
+        return 0
+
+    return sessions.restore(state, time.time() - settings.SESSION_TIMEOUT_SECONDS)
+
+
+def _save_periodically():
+    IOLoop.current().spawn_callback(save_in_background)
+
+
+def start_snapshots():
+    """Periodically save all sessions"""
+    callback = PeriodicCallback(
+        _save_periodically, settings.SESSION_SNAPSHOT_INTERVAL * 1000
+    )
+    callback.start()
+
+    return callback
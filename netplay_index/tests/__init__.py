@@ -1,4 +1,9 @@
 """Tests for netplay-index"""
 
+import netplay_index.settings as settings
+
+# Start every test run with an empty database
+settings.DATABASE_PATH = ":memory:"
+
 name = "tests"
 version = "1.0"
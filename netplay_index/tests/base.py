@@ -7,6 +7,8 @@ import tornado.util
 from tornado.testing import AsyncHTTPTestCase
 
 import netplay_index.__main__ as netplay_index
+import netplay_index.api as api
+import netplay_index.login as login
 import netplay_index.settings as settings
 import netplay_index.sessions as sessions
 
@@ -19,6 +21,9 @@ class NetPlayIndexTest(AsyncHTTPTestCase):
     def get_app(self):
         # This greatly speeds up running tests
         settings.LOGIN_ATTEMPT_DELAY = 0
+        # Every test starts with full request budgets
+        api.RATE_LIMITER.clear()
+        login.login.LOGIN_FAILURES.clear()
         app = netplay_index.make_app()
 
         # Many tests require a session to perform actions on
@@ -40,7 +45,7 @@ class NetPlayIndexTest(AsyncHTTPTestCase):
             self.generate_session(timestamp=time.time() + 100), "8.8.8.8"
         )
 
-        # Pretend this session is old so the clean-up process is triggered
+        # Pretend this session is old so the clean-up process has work to do
         sessions.add_entry(
             self.generate_session(timestamp=time.time() - 100), "8.8.8.8"
         )
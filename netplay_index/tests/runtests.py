@@ -10,8 +10,14 @@ TEST_MODULES = [
     "netplay_index.tests.test_admin",
     "netplay_index.tests.test_api",
     "netplay_index.tests.test_database",
+    "netplay_index.tests.test_feed",
     "netplay_index.tests.test_metrics",
+    "netplay_index.tests.test_profiler",
     "netplay_index.tests.test_redirect",
+    "netplay_index.tests.test_replica",
+    "netplay_index.tests.test_sessions",
+    "netplay_index.tests.test_snapshot",
+    "netplay_index.tests.test_util",
 ]
 
 
@@ -2,12 +2,16 @@
 
 from bs4 import BeautifulSoup
 
+import tornado.gen
 import tornado.util
 from tornado.testing import gen_test
 
 from netplay_index.tests.base import NetPlayIndexTest
 
 import netplay_index.database as database
+import netplay_index.login as login
+import netplay_index.profiler as profiler
+import netplay_index.settings as settings
 import netplay_index.sessions as sessions
 
 
@@ -46,6 +50,68 @@ class LoginTest(NetPlayIndexTest):
 
         database.delete_login("test_user")
 
+    async def post_login(self, username, password, ip="127.0.0.1"):
+        get = await self.http_client.fetch(self.get_url("/login"))
+        xsrf = BeautifulSoup(get.body, "html.parser").find(attrs={"name": "_xsrf"})
+
+        response = await self.http_client.fetch(
+            self.get_url("/login"),
+            method="POST",
+            follow_redirects=False,
+            raise_error=False,
+            headers={"Cookie": "_xsrf={}".format(xsrf["value"]), "X-Real-IP": ip},
+            body="_xsrf={}&username={}&password={}".format(
+                xsrf["value"], username, password
+            ),
+        )
+        return response.code
+
+    @gen_test
+    async def test_throttle(self):
+        if database.login_exists("throttled_user"):
+            database.delete_login("throttled_user")
+
+        database.add_login("throttled_user", "abc")
+        rate, burst = settings.LOGIN_FAILURE_LIMIT
+
+        for _ in range(burst):
+            self.assertEqual(await self.post_login("throttled_user", "def"), 403)
+
+        # Even the right password is turned away for a while
+        self.assertEqual(await self.post_login("throttled_user", "abc"), 429)
+
+        # Failures count against the user, wherever they come from
+        login.login.LOGIN_FAILURES.clear()
+        for _ in range(burst):
+            await self.post_login("throttled_user", "def", ip="6.6.6.6")
+        self.assertEqual(await self.post_login("throttled_user", "abc"), 429)
+
+        database.delete_login("throttled_user")
+
+    @gen_test
+    async def test_throttle_concurrent(self):
+        settings.LOGIN_ATTEMPT_DELAY = 0.1
+        rate, burst = settings.LOGIN_FAILURE_LIMIT
+
+        codes = await tornado.gen.multi(
+            [self.post_login("test_user", "def") for _ in range(burst * 2)]
+        )
+
+        self.assertEqual(sorted(codes), [403] * burst + [429] * burst)
+
+    @gen_test
+    async def test_not_blocking(self):
+        settings.LOGIN_ATTEMPT_DELAY = 0.5
+
+        login_attempt = tornado.gen.convert_yielded(self.post_login("test_user", "def"))
+
+        # The API keeps answering while the login is held back
+        response = await self.http_client.fetch(self.get_url("/v0/list"))
+        self.assertEqual(response.code, 200)
+        self.assertFalse(login_attempt.done())
+
+        self.assertEqual(await login_attempt, 403)
+
 
 class LogoutTest(NetPlayIndexTest):
     """Test for the logout page"""
@@ -413,3 +479,62 @@ class AdminBansTest(NetPlayIndexTest):
         self.assertEqual(post.code, 200)
 
         database.delete_login("test_user")
+
+
+class AdminProfilerTest(NetPlayIndexTest):
+    """Test for /admin/profiler"""
+
+    @gen_test
+    async def test_post(self):
+        login_cookie = await self.login()
+
+        get = await self.http_client.fetch(
+            self.get_url("/admin/profiler"),
+            headers={"Cookie": login_cookie},
+            follow_redirects=False,
+        )
+        self.assertEqual(get.code, 200)
+
+        xsrf = _get_xsrf(get.body, "profile")
+        cookie = login_cookie + ";" + get.headers["Set-Cookie"]
+
+        post = await self.http_client.fetch(
+            self.get_url("/admin/profiler"),
+            headers={"Cookie": cookie},
+            method="POST",
+            body="_xsrf={}&action=profile&duration=0.1".format(xsrf),
+            follow_redirects=False,
+        )
+        self.assertEqual(post.code, 200)
+
+        while profiler.PROFILE.finished is None:
+            await tornado.gen.sleep(0.05)
+
+        stacks = await self.http_client.fetch(
+            self.get_url("/admin/profiler?format=collapsed"),
+            headers={"Cookie": login_cookie},
+            follow_redirects=False,
+        )
+        self.assertEqual(stacks.code, 200)
+        self.assertEqual(stacks.body.decode(), profiler.PROFILE.collapsed())
+
+        post = await self.http_client.fetch(
+            self.get_url("/admin/profiler"),
+            headers={"Cookie": cookie},
+            method="POST",
+            body="_xsrf={}&action=profile&duration=1000".format(xsrf),
+            follow_redirects=False,
+            raise_error=False,
+        )
+        self.assertEqual(post.code, 403)
+
+        database.delete_login("test_user")
+
+    @gen_test
+    async def test_not_logged_in(self):
+        response = await self.http_client.fetch(
+            self.get_url("/admin/profiler?format=collapsed"),
+            follow_redirects=False,
+            raise_error=False,
+        )
+        self.assertEqual(response.code, 403)
@@ -1,11 +1,16 @@
 """Checks whether the API functions properly"""
 
 import json
+import math
+import time
+import urllib.parse
 
+import prometheus_client
 import tornado.util
 from tornado.testing import gen_test
 
 from netplay_index.tests.base import NetPlayIndexTest
+import netplay_index.api as api
 import netplay_index.sessions as sessions
 import netplay_index.settings as settings
 import netplay_index.database as database
@@ -63,6 +68,228 @@ class ListTest(NetPlayIndexTest):
 
         self.assertEqual(body["status"], "OK")
 
+    @gen_test
+    def test_filters(self):
+        session = self.generate_session(timestamp=time.time() + 100)
+        session.update(region="NA", version="5.0-1337", password=True)
+        secret = sessions.add_entry(session, "127.0.0.1")
+
+        response = yield self.http_client.fetch(
+            self.get_url("/v0/list?region=NA&version=5.0-1337&password=1&name=SERVER")
+        )
+        body = json.loads(response.body)
+        self.assertEqual(
+            body["sessions"], [sessions.get_entry(secret).to_listed_dict()]
+        )
+
+        response = yield self.http_client.fetch(
+            self.get_url("/v0/list?region=NA&version=5.0-1337&password=0")
+        )
+        body = json.loads(response.body)
+        self.assertEqual(body["sessions"], [])
+
+        sessions.update_entry(secret, password=False)
+
+        response = yield self.http_client.fetch(
+            self.get_url("/v0/list?region=NA&version=5.0-1337&password=0")
+        )
+        body = json.loads(response.body)
+        self.assertEqual(len(body["sessions"]), 1)
+
+        sessions.remove_entry(secret)
+
+        response = yield self.http_client.fetch(self.get_url("/v0/list?region=NA"))
+        body = json.loads(response.body)
+        self.assertEqual(body["sessions"], [])
+
+    @gen_test
+    def test_search(self):
+        session = self.generate_session(timestamp=time.time() + 100)
+        session.update(name="Dolphin Party", game="Mario Kart: Double Dash!!")
+        secret = sessions.add_entry(session, "127.0.0.1")
+
+        for query in ["name=PHIN+P", "name=ty", "game=kart&name=dolphin"]:
+            response = yield self.http_client.fetch(self.get_url("/v0/list?" + query))
+            body = json.loads(response.body)
+            self.assertIn(sessions.get_entry(secret).to_listed_dict(), body["sessions"])
+
+        # All trigrams of "bcabc" occur in "Abcab", but not the string itself
+        session = self.generate_session(timestamp=time.time() + 100)
+        session.update(name="Abcab")
+        other_secret = sessions.add_entry(session, "127.0.0.1")
+
+        response = yield self.http_client.fetch(self.get_url("/v0/list?name=bcabc"))
+        body = json.loads(response.body)
+        self.assertEqual(body["sessions"], [])
+
+        sessions.remove_entry(other_secret)
+
+        sessions.update_entry(secret, game="Super Smash Bros. Melee")
+
+        response = yield self.http_client.fetch(self.get_url("/v0/list?game=kart"))
+        body = json.loads(response.body)
+        self.assertEqual(body["sessions"], [])
+
+        response = yield self.http_client.fetch(self.get_url("/v0/list?game=MELEE"))
+        body = json.loads(response.body)
+        self.assertEqual(
+            body["sessions"], [sessions.get_entry(secret).to_listed_dict()]
+        )
+
+        sessions.remove_entry(secret)
+
+    @gen_test
+    def test_etag(self):
+        url = self.get_url("/v0/list?region=EU&in_game=1")
+
+        response = yield self.http_client.fetch(url)
+        self.assertEqual(response.code, 200)
+        etag = response.headers["Etag"]
+
+        response = yield self.http_client.fetch(
+            url, headers={"If-None-Match": etag}, raise_error=False
+        )
+        self.assertEqual(response.code, 304)
+        self.assertEqual(response.body, b"")
+
+        secret = sessions.add_entry(
+            self.generate_session(timestamp=time.time() + 100), "127.0.0.1"
+        )
+
+        response = yield self.http_client.fetch(url, headers={"If-None-Match": etag})
+        self.assertEqual(response.code, 200)
+        self.assertNotEqual(response.headers["Etag"], etag)
+
+        body = json.loads(response.body)
+        self.assertIn(sessions.get_entry(secret).to_listed_dict(), body["sessions"])
+
+        sessions.remove_entry(secret)
+
+    @gen_test
+    def test_heartbeat(self):
+        url = self.get_url("/v0/list?region=EU")
+        secret = sessions.add_entry(
+            self.generate_session(timestamp=time.time() + 100), "127.0.0.1"
+        )
+
+        before = yield self.http_client.fetch(url)
+        self.assertNotIn("timestamp", json.loads(before.body)["sessions"][0])
+
+        # Heartbeats don't make a new revision, so the list can't change
+        sessions.update_entry(secret, timestamp=time.time() + 200)
+        api.LIST_CACHE.clear()
+
+        after = yield self.http_client.fetch(url)
+        self.assertEqual(after.body, before.body)
+        self.assertEqual(after.headers["Etag"], before.headers["Etag"])
+
+        sessions.remove_entry(secret)
+
+    @gen_test
+    def test_since(self):
+        response = yield self.http_client.fetch(self.get_url("/v0/list?region=SA"))
+        body = json.loads(response.body)
+        revision = body["revision"]
+        self.assertEqual(body["sessions"], [])
+
+        session = self.generate_session(timestamp=time.time() + 100)
+        session.update(region="SA")
+        added = sessions.add_entry(session, "127.0.0.1")
+        removed = sessions.add_entry(session.copy(), "127.0.0.1")
+        sessions.add_entry(
+            self.generate_session(timestamp=time.time() + 100), "127.0.0.1"
+        )
+
+        response = yield self.http_client.fetch(
+            self.get_url("/v0/list?region=SA&since={}".format(revision))
+        )
+        body = json.loads(response.body)
+        self.assertEqual(len(body["sessions"]), 2)
+        self.assertEqual(body["removed"], [])
+        revision = body["revision"]
+
+        sessions.update_entry(added, player_count=5)
+        removed_id = sessions.get_entry(removed)["id"]
+        sessions.remove_entry(removed)
+
+        response = yield self.http_client.fetch(
+            self.get_url("/v0/list?region=SA&since={}".format(revision))
+        )
+        body = json.loads(response.body)
+        self.assertEqual(body["sessions"], [sessions.get_entry(added).to_listed_dict()])
+        self.assertEqual(body["removed"], [removed_id])
+
+        # Too old or unknown revisions get a full list instead
+        for since in [-1, body["revision"] + 1]:
+            response = yield self.http_client.fetch(
+                self.get_url("/v0/list?region=SA&since={}".format(since))
+            )
+            body = json.loads(response.body)
+            self.assertNotIn("removed", body)
+            self.assertEqual(
+                body["sessions"], [sessions.get_entry(added).to_listed_dict()]
+            )
+
+        sessions.remove_entry(added)
+
+    @gen_test
+    def test_pages(self):
+        secrets = []
+        for player_count in [5, 3, 4, 1, 2]:
+            session = self.generate_session(timestamp=time.time() + 100)
+            session.update(region="OC", player_count=player_count)
+            secrets.append(sessions.add_entry(session, "127.0.0.1"))
+
+        player_counts = []
+        url = "/v0/list?region=OC&sort=player_count&limit=2"
+        cursor = ""
+
+        while cursor is not None:
+            response = yield self.http_client.fetch(self.get_url(url + cursor))
+            body = json.loads(response.body)
+            self.assertLessEqual(len(body["sessions"]), 2)
+
+            player_counts += [s["player_count"] for s in body["sessions"]]
+            cursor = body.get("cursor")
+            if cursor is not None:
+                cursor = "&cursor=" + cursor
+
+        self.assertEqual(player_counts, [1, 2, 3, 4, 5])
+
+        response = yield self.http_client.fetch(
+            self.get_url("/v0/list?region=OC&sort=-player_count&limit=3")
+        )
+        body = json.loads(response.body)
+        self.assertEqual([s["player_count"] for s in body["sessions"]], [5, 4, 3])
+
+        # Newest first, walking all sessions
+        response = yield self.http_client.fetch(self.get_url("/v0/list?limit=2"))
+        body = json.loads(response.body)
+        self.assertEqual(
+            body["sessions"],
+            [
+                sessions.get_entry(secrets[4]).to_listed_dict(),
+                sessions.get_entry(secrets[3]).to_listed_dict(),
+            ],
+        )
+
+        yield self.bad_request(
+            400, "BAD_SORT", {"request": self.get_url("/v0/list?sort=timestamp")}
+        )
+
+        yield self.bad_request(
+            400,
+            "BAD_CURSOR",
+            {"request": self.get_url("/v0/list?sort=name&cursor=" + body["cursor"])},
+        )
+
+        yield self.bad_request(
+            400, "BAD_CURSOR", {"request": self.get_url("/v0/list?cursor=foo")}
+        )
+
+        for secret in secrets:
+            sessions.remove_entry(secret)
+
     @gen_test
     def test_bad_request(self):
         yield self.bad_request(
@@ -186,6 +413,16 @@ class SessionAddTest(NetPlayIndexTest):
             {"request": self.build_url(), "headers": {"X-Real-IP": "1.1.1.1"}},
         )
 
+        for secret in list(sessions.get_host_sessions("1.1.1.1")):
+            sessions.remove_entry(secret)
+
+        self.assertEqual(sessions.get_host_session_count("1.1.1.1"), 0)
+
+        response = yield self.http_client.fetch(
+            self.build_url(), headers={"X-Real-IP": "1.1.1.1"}
+        )
+        self.assertEqual(response.code, 200)
+
 
 class SessionActiveTest(NetPlayIndexTest):
     """Tests for session/active"""
@@ -252,6 +489,106 @@ class SessionActiveTest(NetPlayIndexTest):
         self.assertEqual(body["status"], "OK")
 
 
+class SessionActiveBatchTest(NetPlayIndexTest):
+    """Tests for session/active_batch"""
+
+    def build_url(self, updates):
+        return self.get_url(
+            "/v0/session/active_batch?sessions="
+            + urllib.parse.quote(json.dumps(updates))
+        )
+
+    @gen_test
+    def test_bad_requests(self):
+        """Bad requests"""
+
+        yield self.bad_request(
+            400,
+            "PARSE_ERROR",
+            {"request": self.get_url("/v0/session/active_batch?sessions=nope")},
+        )
+
+        yield self.bad_request(
+            400, "PARSE_ERROR", {"request": self.build_url({"secret": "foo"})}
+        )
+
+        yield self.bad_request(
+            400,
+            "TOO_MANY_SESSIONS",
+            {
+                "request": self.build_url(
+                    [{"secret": "foo"}] * (settings.MAXIMUM_SESSIONS_PER_HOST + 1)
+                )
+            },
+        )
+
+        # Each session only once, otherwise nothing is updated
+        secret = sessions.add_entry(self.generate_session(), "127.0.0.1")
+        yield self.bad_request(
+            400,
+            "PARSE_ERROR",
+            {
+                "request": self.build_url(
+                    [
+                        {"secret": secret, "player_count": 3},
+                        {"secret": " {} ".format(secret), "player_count": 4},
+                    ]
+                )
+            },
+        )
+        self.assertEqual(sessions.get_entry(secret)["player_count"], 2)
+        sessions.remove_entry(secret)
+
+    @gen_test
+    def test_valid_request(self):
+        """Valid request"""
+        first = sessions.add_entry(self.generate_session(), "127.0.0.1")
+        second = sessions.add_entry(self.generate_session(), "127.0.0.1")
+        third = sessions.add_entry(self.generate_session(), "127.0.0.1")
+
+        for entry in database.blacklist_get():
+            if entry[0] == "nasty":
+                database.blacklist_remove("nasty")
+                break
+
+        database.blacklist_add("nasty", "test_user", "it's a bad word")
+
+        response = yield self.http_client.fetch(
+            self.build_url(
+                [
+                    {"secret": first, "player_count": 3, "game": "foo"},
+                    {"secret": second, "in_game": 0, "game": "a nasty word"},
+                    {"secret": "not_a_session"},
+                    {"secret": third, "player_count": "many"},
+                    {"secret": 42},
+                ]
+            )
+        )
+        self.assertEqual(response.code, 200)
+
+        database.blacklist_remove("nasty")
+
+        body = json.loads(response.body)
+        self.assertEqual(body["status"], "OK")
+        self.assertEqual(
+            body["results"],
+            {
+                first: "OK",
+                second: "BLACKLISTED_WORD",
+                "not_a_session": "BAD_SESSION",
+                third: "PARSE_ERROR",
+                "42": "PARSE_ERROR",
+            },
+        )
+
+        self.assertEqual(sessions.get_entry(first)["player_count"], 3)
+        self.assertEqual(sessions.get_entry(first)["game"], "foo")
+        self.assertEqual(sessions.get_entry(third)["player_count"], 2)
+
+        sessions.remove_entry(first)
+        sessions.remove_entry(second)
+
+
 class SessionRemoveTest(NetPlayIndexTest):
     """Tests for session/remove"""
 
@@ -278,3 +615,91 @@ class SessionRemoveTest(NetPlayIndexTest):
         body = json.loads(response.body)
 
         self.assertEqual(body["status"], "OK")
+
+
+class CleanupTest(NetPlayIndexTest):
+    """Tests for the removal of timed-out sessions"""
+
+    def test_cleanup(self):
+        expired = sessions.add_entry(
+            self.generate_session(timestamp=time.time() - 100), "127.0.0.1"
+        )
+        refreshed = sessions.add_entry(
+            self.generate_session(timestamp=time.time() - 100), "127.0.0.1"
+        )
+        sessions.update_entry(refreshed, timestamp=time.time())
+
+        api._cleanup_sessions()
+
+        self.assertEqual(sessions.get_entry(expired), None)
+        self.assertNotEqual(sessions.get_entry(refreshed), None)
+
+        for session in sessions.get_all().values():
+            self.assertGreater(
+                session["timestamp"], time.time() - settings.SESSION_TIMEOUT_SECONDS
+            )
+
+        sessions.remove_entry(refreshed)
+
+
+class RateLimitTest(NetPlayIndexTest):
+    """Tests for per-IP request budgets"""
+
+    def throttled_count(self, action):
+        return (
+            prometheus_client.REGISTRY.get_sample_value(
+                "api_throttled_request_count_total", {"action": action}
+            )
+            or 0
+        )
+
+    @gen_test
+    def test_rate_limit(self):
+        rate, burst = settings.RATE_LIMITS["list"]
+        throttled = self.throttled_count("list")
+
+        for _ in range(burst):
+            response = yield self.http_client.fetch(self.get_url("/v0/list"))
+            self.assertEqual(response.code, 200)
+
+        response = yield self.http_client.fetch(
+            self.get_url("/v0/list"), raise_error=False
+        )
+        self.assertEqual(response.code, 429)
+        self.assertEqual(json.loads(response.body)["status"], "RATE_LIMITED")
+        self.assertEqual(int(response.headers["Retry-After"]), math.ceil(1 / rate))
+        self.assertEqual(self.throttled_count("list"), throttled + 1)
+
+        # Other actions and hosts have budgets of their own
+        yield self.bad_request(
+            400, "BAD_SESSION", {"request": self.get_url("/v0/session/remove")}
+        )
+
+        response = yield self.http_client.fetch(
+            self.get_url("/v0/list"), headers={"X-Real-IP": "5.5.5.5"}
+        )
+        self.assertEqual(response.code, 200)
+
+    @gen_test
+    async def test_ipv6_prefix(self):
+        rate, burst = settings.RATE_LIMITS["list"]
+
+        # Addresses in the same /64 share a budget
+        for index in range(burst):
+            response = await self.http_client.fetch(
+                self.get_url("/v0/list"),
+                headers={"X-Real-IP": "2001:db8:1:2::{:x}".format(index + 1)},
+            )
+            self.assertEqual(response.code, 200)
+
+        response = await self.http_client.fetch(
+            self.get_url("/v0/list"),
+            headers={"X-Real-IP": "2001:db8:1:2:ffff::1"},
+            raise_error=False,
+        )
+        self.assertEqual(response.code, 429)
+
+        response = await self.http_client.fetch(
+            self.get_url("/v0/list"), headers={"X-Real-IP": "2001:db8:1:3::1"}
+        )
+        self.assertEqual(response.code, 200)
@@ -1,10 +1,18 @@
 """Checks whether the API functions properly"""
 
 import json
+import os
+import tempfile
 import netplay_index.database as database
 
 from unittest import TestCase
 
+from tornado.testing import AsyncTestCase, gen_test
+
+
+def setUpModule():
+    database.initialize()
+
 
 class BanTest(TestCase):
     def runTest(self):
@@ -36,3 +44,118 @@ class BlacklistTest(TestCase):
         self.assertEqual(can_blacklist, True)
 
         database.delete_login("test_user")
+
+
+class PermissionsTest(TestCase):
+    def runTest(self):
+        if database.login_exists("test_user"):
+            database.delete_login("test_user")
+
+        self.assertEqual(database.is_sysop("test_user"), False)
+
+        database.add_login("test_user", "abc", sysop=True)
+
+        # Loaded once, then served from memory
+        permissions = database.get_permissions("test_user")
+        self.assertIs(database.get_permissions("test_user"), permissions)
+        self.assertEqual(permissions.sysop, True)
+        self.assertEqual(permissions.can_ban, True)
+        self.assertEqual(permissions.can_modify_blacklist, True)
+
+        database.update_login("test_user", "def")
+        self.assertIsNot(database.get_permissions("test_user"), permissions)
+
+        database.delete_login("test_user")
+        self.assertEqual(database.is_sysop("test_user"), False)
+        self.assertEqual(database.can_ban("test_user"), False)
+
+
+class BlacklistPatternTest(TestCase):
+    def runTest(self):
+        for word in ["nasty", "bad[word"]:
+            if database.is_string_blacklisted(word):
+                database.blacklist_remove(word)
+
+        self.assertEqual(database.is_string_blacklisted("a nasty name"), False)
+
+        database.blacklist_add("nasty", "test_user", "test")
+        database.blacklist_add("bad[word", "test_user", "test")
+
+        self.assertEqual(database.is_string_blacklisted("a NASTY name"), True)
+        self.assertEqual(database.is_string_blacklisted("a bad[word name"), True)
+        self.assertEqual(database.is_string_blacklisted("dynasty"), False)
+
+        database.blacklist_remove("nasty")
+        database.blacklist_remove("bad[word")
+
+        self.assertEqual(database.is_string_blacklisted("a nasty name"), False)
+
+        # Inline flags only work at the start of the combined pattern and
+        # backreferences would point at the wrong group in it
+        database.blacklist_add("nasty", "test_user", "test")
+        database.blacklist_add("(?i)foo", "test_user", "test")
+        database.blacklist_add(r"(ba)\1r", "test_user", "test")
+        database.initialize()
+
+        self.assertEqual(database.is_string_blacklisted("a foo name"), False)
+        self.assertEqual(database.is_string_blacklisted("a BABAR name"), True)
+        self.assertEqual(database.is_string_blacklisted("a bar name"), False)
+
+        self.assertEqual(database.is_string_blacklisted("a nasty name"), True)
+
+        database.blacklist_remove("nasty")
+        database.blacklist_remove("(?i)foo")
+        database.blacklist_remove(r"(ba)\1r")
+
+        self.assertEqual(database.is_string_blacklisted("a babar name"), False)
+
+
+class BanRangeTest(TestCase):
+    def runTest(self):
+        for host in ["10.1.0.0/16", "2001:db8::/64", "10.2.3.4"]:
+            database.ban_remove(host)
+
+        database.ban_add("10.1.0.0/16", "test_user", "test")
+        database.ban_add("2001:db8::/64", "test_user", "test")
+        database.ban_add("10.2.3.4", "test_user", "test")
+
+        self.assertEqual(database.is_host_banned("10.1.255.1"), True)
+        self.assertEqual(database.is_host_banned("10.2.3.4"), True)
+        self.assertEqual(database.is_host_banned("::ffff:10.1.0.1"), True)
+        self.assertEqual(database.is_host_banned("2001:db8::1234"), True)
+        self.assertEqual(database.is_host_banned("10.2.3.5"), False)
+        self.assertEqual(database.is_host_banned("2001:db8:0:1::1"), False)
+
+        database.ban_remove("10.1.0.0/16")
+        database.ban_remove("2001:db8::/64")
+        database.ban_remove("10.2.3.4")
+
+        self.assertEqual(database.is_host_banned("10.1.255.1"), False)
+        self.assertEqual(database.is_host_banned("2001:db8::1234"), False)
+
+
+class ConnectionTest(TestCase):
+    def runTest(self):
+        with tempfile.TemporaryDirectory() as directory:
+            connection = database._connect(os.path.join(directory, "test.db"))
+
+            self.assertEqual(
+                connection.execute("PRAGMA journal_mode").fetchone()[0], "wal"
+            )
+            # NORMAL
+            self.assertEqual(connection.execute("PRAGMA synchronous").fetchone()[0], 1)
+
+            connection.close()
+
+
+class WriterTest(AsyncTestCase):
+    @gen_test
+    async def test_ban(self):
+        await database.ban_add_async("192.0.2.1", "test_user", "test")
+
+        self.assertEqual(database.is_host_banned("192.0.2.1"), True)
+        self.assertIn("192.0.2.1", [ban[0] for ban in database.bans_get()])
+
+        await database.ban_remove_async("192.0.2.1")
+
+        self.assertEqual(database.is_host_banned("192.0.2.1"), False)
@@ -0,0 +1,181 @@
+"""Checks whether the session feed functions properly"""
+
+import json
+
+from tornado import gen
+from tornado.concurrent import Future
+from tornado.httpclient import HTTPClientError, HTTPRequest
+from tornado.testing import gen_test
+from tornado.websocket import websocket_connect
+
+from netplay_index.tests.base import NetPlayIndexTest
+import netplay_index.feed as feed
+import netplay_index.sessions as sessions
+import netplay_index.settings as settings
+
+
+class FeedTest(NetPlayIndexTest):
+    """Tests for /feed"""
+
+    def get_ws_url(self, path):
+        return self.get_url(path).replace("http://", "ws://")
+
+    async def read(self, connection):
+        return json.loads(await connection.read_message())
+
+    @gen_test
+    async def test_bad_request(self):
+        for path, code, status in [
+            ("/v666/feed", 400, "BAD_VERSION"),
+            ("/v0/feed?password=maybe", 400, "PARSE_ERROR"),
+        ]:
+            with self.assertRaises(HTTPClientError) as context:
+                await websocket_connect(self.get_ws_url(path))
+
+            self.assertEqual(context.exception.code, code)
+            self.assertEqual(
+                json.loads(context.exception.response.body)["status"], status
+            )
+
+    @gen_test
+    async def test_limits(self):
+        for name, value in [
+            ("FEED_MAX_SUBSCRIPTIONS_PER_HOST", 2),
+            ("FEED_MAX_GROUPS", 2),
+        ]:
+            self.addCleanup(setattr, settings, name, getattr(settings, name))
+            setattr(settings, name, value)
+
+        first = await websocket_connect(self.get_ws_url("/v0/feed?region=EU"))
+        second = await websocket_connect(self.get_ws_url("/v0/feed?region=EU"))
+
+        with self.assertRaises(HTTPClientError) as context:
+            await websocket_connect(self.get_ws_url("/v0/feed?region=EU"))
+        self.assertEqual(context.exception.code, 429)
+
+        # Other hosts have their own limit, but not their own groups
+        other = await websocket_connect(
+            HTTPRequest(
+                self.get_ws_url("/v0/feed?region=NA"), headers={"X-Real-IP": "5.5.5.5"}
+            )
+        )
+
+        with self.assertRaises(HTTPClientError) as context:
+            await websocket_connect(
+                HTTPRequest(
+                    self.get_ws_url("/v0/feed?region=OC"),
+                    headers={"X-Real-IP": "5.5.5.5"},
+                )
+            )
+        self.assertEqual(context.exception.code, 503)
+
+        # Closed subscriptions make room again
+        second.close()
+        while feed.HOST_SUBSCRIPTIONS["127.0.0.1"] > 1:
+            await gen.sleep(0.01)
+
+        second = await websocket_connect(self.get_ws_url("/v0/feed?region=EU"))
+
+        for connection in [first, second, other]:
+            connection.close()
+
+    @gen_test
+    async def test_events(self):
+        session = self.generate_session()
+        session["game"] = "Feed Game"
+        secret = sessions.add_entry(session, "8.8.8.8")
+
+        connection = await websocket_connect(
+            self.get_ws_url("/v0/feed?game=feed+game&in_game=1")
+        )
+
+        snapshot = await self.read(connection)
+        self.assertEqual(snapshot["type"], "snapshot")
+        self.assertEqual(snapshot["revision"], sessions.generation)
+        self.assertEqual(len(snapshot["sessions"]), 1)
+        self.assertEqual(snapshot["sessions"][0]["game"], "Feed Game")
+
+        # Changes to other sessions aren't sent
+        other = sessions.add_entry(self.generate_session(), "8.8.8.8")
+        sessions.remove_entry(other)
+
+        sessions.update_entry(secret, player_count=3)
+        message = await self.read(connection)
+        self.assertEqual(message["type"], "update")
+        self.assertEqual(message["session"]["player_count"], 3)
+
+        # Sessions no longer matching the filters are removed...
+        sessions.update_entry(secret, in_game=False)
+        message = await self.read(connection)
+        self.assertEqual(message["type"], "remove")
+        self.assertEqual(message["id"], snapshot["sessions"][0]["id"])
+
+        # ... and added again once they do
+        sessions.update_entry(secret, in_game=True)
+        message = await self.read(connection)
+        self.assertEqual(message["type"], "add")
+        self.assertEqual(message["revision"], sessions.generation)
+
+        sessions.remove_entry(secret)
+        message = await self.read(connection)
+        self.assertEqual(message["type"], "remove")
+
+        connection.close()
+
+    @gen_test
+    async def test_groups(self):
+        first = await websocket_connect(self.get_ws_url("/v0/feed?region=EU&game=x"))
+        second = await websocket_connect(self.get_ws_url("/v0/feed?game=X&region=EU"))
+        third = await websocket_connect(self.get_ws_url("/v0/feed?region=NA"))
+
+        for connection in [first, second, third]:
+            await self.read(connection)
+
+        # Subscribers with the same filters share a group
+        key = feed.group_key({"region": "EU"}, {"game": "x"})
+        self.assertEqual(len(feed.GROUPS[key].members), 2)
+
+        session = self.generate_session()
+        session["game"] = "X"
+        secret = sessions.add_entry(session, "8.8.8.8")
+
+        first_message = await first.read_message()
+        self.assertEqual(first_message, await second.read_message())
+        self.assertEqual(json.loads(first_message)["type"], "add")
+
+        sessions.remove_entry(secret)
+        await first.read_message()
+        await second.read_message()
+
+        for connection in [first, second, third]:
+            connection.close()
+
+    @gen_test
+    async def test_slow_consumer(self):
+        connection = await websocket_connect(self.get_ws_url("/v0/feed?region=OC"))
+        await self.read(connection)
+
+        (subscriber,) = feed.GROUPS[feed.group_key({"region": "OC"}, {})].members
+
+        # Pretend the client stopped reading
+        subscriber.pending = settings.FEED_MAX_PENDING_MESSAGES
+
+        session = self.generate_session()
+        session["region"] = "OC"
+        secret = sessions.add_entry(session, "8.8.8.8")
+        sessions.update_entry(secret, player_count=3)
+        self.assertTrue(subscriber.stale)
+
+        # Once the backlog is flushed, a fresh snapshot replaces the skipped events
+        written = Future()
+        written.set_result(None)
+        subscriber.pending = 1
+        subscriber._on_written(written)
+
+        snapshot = await self.read(connection)
+        self.assertEqual(snapshot["type"], "snapshot")
+        self.assertEqual(len(snapshot["sessions"]), 1)
+        self.assertEqual(snapshot["sessions"][0]["player_count"], 3)
+
+        sessions.remove_entry(secret)
+        connection.close()
@@ -1,8 +1,18 @@
 """Tests for /metrics"""
 
+import gzip
+import os
+import subprocess
+import sys
+import tempfile
+from unittest import TestCase
+
+import prometheus_client
 from tornado.testing import gen_test
 
 from netplay_index.tests.base import NetPlayIndexTest
+import netplay_index.metrics as metrics
+import netplay_index.settings as settings
 
 
 class MetricsTest(NetPlayIndexTest):
@@ -10,3 +20,141 @@ class MetricsTest(NetPlayIndexTest):
     def test_get(self):
         response = yield self.http_client.fetch(self.get_url("/metrics"))
         self.assertEqual(response.code, 200)
+
+    @gen_test
+    async def test_cache(self):
+        self.addCleanup(
+            setattr, settings, "METRICS_CACHE_TTL", settings.METRICS_CACHE_TTL
+        )
+        settings.METRICS_CACHE_TTL = 60
+        metrics.EXPOSITION = None
+
+        response = await self.http_client.fetch(
+            self.get_url("/metrics"),
+            headers={"Accept-Encoding": "gzip"},
+            decompress_response=False,
+        )
+        self.assertEqual(response.headers["Content-Encoding"], "gzip")
+        exposition = gzip.decompress(response.body)
+        self.assertIn(b"api_request_count", exposition)
+
+        metrics.API_REQUEST_COUNT.inc()
+
+        # Served from the cache until it expires
+        response = await self.http_client.fetch(self.get_url("/metrics"))
+        self.assertNotIn("Content-Encoding", response.headers)
+        self.assertEqual(response.body, exposition)
+
+        metrics.EXPOSITION = None
+        response = await self.http_client.fetch(self.get_url("/metrics"))
+        self.assertNotEqual(response.body, exposition)
+
+    @gen_test
+    async def test_latency(self):
+        def sample(name, labels=None):
+            return prometheus_client.REGISTRY.get_sample_value(name, labels or {}) or 0
+
+        labels = {"action": "list", "status": "200"}
+        requests = sample("api_request_latency_seconds_count", labels)
+        lists = sample("api_list_result_size_count")
+        unknown = sample(
+            "api_request_latency_seconds_count", {"action": "other", "status": "404"}
+        )
+
+        await self.http_client.fetch(self.get_url("/v0/list"))
+        await self.http_client.fetch(
+            self.get_url("/v0/no/such/action"), raise_error=False
+        )
+
+        self.assertEqual(
+            sample("api_request_latency_seconds_count", labels), requests + 1
+        )
+        self.assertEqual(sample("api_list_result_size_count"), lists + 1)
+        self.assertEqual(
+            sample(
+                "api_request_latency_seconds_count",
+                {"action": "other", "status": "404"},
+            ),
+            unknown + 1,
+        )
+        self.assertGreater(sample("ban_check_duration_seconds_count"), 0)
+
+
+class SpaceSavingTest(TestCase):
+    def runTest(self):
+        sketch = metrics.SpaceSaving(2)
+
+        for value in ["a", "a", "a", "b"]:
+            self.assertIsNone(sketch.add(value))
+
+        # The least counted value makes room
+        self.assertEqual(sketch.add("c"), "b")
+        self.assertEqual(sketch.counters, {"a": [3, 0], "c": [2, 1]})
+        self.assertEqual(len(sketch), 2)
+
+        for _ in range(3):
+            sketch.add("d")
+        self.assertIn("a", sketch)
+        self.assertIn("d", sketch)
+        self.assertNotIn("c", sketch)
+
+
+class MultiprocessDirectoryTest(TestCase):
+    def runTest(self):
+        directory = tempfile.TemporaryDirectory()
+        self.addCleanup(directory.cleanup)
+        self.addCleanup(
+            setattr, metrics, "MULTIPROCESS_DIRECTORY", metrics.MULTIPROCESS_DIRECTORY
+        )
+        metrics.MULTIPROCESS_DIRECTORY = directory.name
+
+        dead = subprocess.Popen([sys.executable, "-c", ""])
+        dead.wait()
+
+        for name in [
+            "counter_{}.db".format(dead.pid),
+            "gauge_livesum_{}.db".format(dead.pid),
+            "gauge_livesum_{}.db".format(os.getpid()),
+        ]:
+            open(os.path.join(directory.name, name), "w").close()
+
+        # Counts of dead workers are kept, their live gauges aren't
+        metrics.mark_dead_processes()
+        self.assertEqual(
+            sorted(os.listdir(directory.name)),
+            [
+                "counter_{}.db".format(dead.pid),
+                "gauge_livesum_{}.db".format(os.getpid()),
+            ],
+        )
+
+        metrics.clear_multiprocess_directory()
+        self.assertEqual(os.listdir(directory.name), [])
+
+
+class SessionDetailsTest(TestCase):
+    def runTest(self):
+        details = metrics.SessionDetails(2, None)
+
+        details.inc("A", True, "direct", "5.0")
+        details.inc("A", False, "direct", "5.0")
+        details.inc("B", False, "direct", "5.0")
+        details.inc("C", False, "traversal", "5.0")
+
+        self.assertEqual(
+            details.counts,
+            {
+                ("A", "True", "direct", "5.0"): 1,
+                ("A", "False", "direct", "5.0"): 1,
+                ("other", "False", "direct", "5.0"): 1,
+                ("C", "False", "traversal", "5.0"): 1,
+            },
+        )
+
+        counts, top, error = details.collect()
+        self.assertEqual(sum(sample.value for sample in counts.samples), 4)
+        self.assertIn(
+            (("field", "game"), ("value", "C"), 2),
+            [(*sorted(sample.labels.items()), sample.value) for sample in top.samples],
+        )
+        self.assertIn(1, [sample.value for sample in error.samples])
@@ -0,0 +1,33 @@
+"""Checks whether the profiler finds where time is spent"""
+
+import time
+from unittest import TestCase
+
+import netplay_index.profiler as profiler
+
+
+def _busy(seconds):
+    deadline = time.monotonic() + seconds
+    while time.monotonic() < deadline:
+        pass
+
+
+class ProfilerTest(TestCase):
+    def runTest(self):
+        self.assertTrue(profiler.start(0.2))
+        self.assertFalse(profiler.start(0.2))
+
+        _busy(0.3)
+        profile = profiler.PROFILE
+        while profile.finished is None:
+            time.sleep(0.01)
+
+        self.assertGreater(profile.samples, 0)
+
+        functions = [function for function, _, _ in profile.top_functions()]
+        self.assertTrue(functions[0].startswith("_busy (tests/test_profiler.py:"))
+
+        for line in profile.collapsed().splitlines():
+            stack, count = line.rsplit(" ", 1)
+            self.assertGreater(int(count), 0)
+            self.assertIn("runTest (tests/test_profiler.py:", stack)
@@ -0,0 +1,168 @@
+"""Checks whether sessions are shared between worker processes properly"""
+
+import json
+import marshal
+import os
+
+import tornado.httpserver
+import tornado.testing
+from tornado.testing import gen_test
+
+from netplay_index.tests.base import NetPlayIndexTest
+import netplay_index.__main__ as netplay_index
+import netplay_index.replica as replica
+import netplay_index.sessions as sessions
+
+
+class ReplicateTest(NetPlayIndexTest):
+    """Tests for the owner's /replicate"""
+
+    def get_app(self):
+        return netplay_index.make_owner_app(super().get_app())
+
+    async def replicate(self, since, epoch):
+        response = await self.http_client.fetch(
+            self.get_url("/replicate?since={}&epoch={}".format(since, epoch)),
+            headers={"X-Replication-Token": replica.TOKEN},
+        )
+        return marshal.loads(response.body)
+
+    @gen_test
+    async def test_bad_token(self):
+        response = await self.http_client.fetch(
+            self.get_url("/replicate?since=0&epoch=0"), raise_error=False
+        )
+        self.assertEqual(response.code, 403)
+
+    @gen_test
+    async def test_quiet_log(self):
+        with self.assertLogs("tornado.access", level="DEBUG") as logs:
+            await self.replicate(sessions.generation, str(os.getpid()))
+            await self.http_client.fetch(
+                self.get_url("/replicate?since=0&epoch=0"), raise_error=False
+            )
+            await self.http_client.fetch(self.get_url("/v0/list"))
+
+        self.assertEqual(
+            [(record.levelname, record.args[0]) for record in logs.records],
+            [("DEBUG", 200), ("WARNING", 403), ("INFO", 200)],
+        )
+
+    @gen_test
+    async def test_not_public(self):
+        public = tornado.httpserver.HTTPServer(netplay_index.make_app())
+        sock, port = tornado.testing.bind_unused_port()
+        public.add_sockets([sock])
+
+        response = await self.http_client.fetch(
+            "http://127.0.0.1:{}/replicate?since=0&epoch=0".format(port),
+            headers={"X-Replication-Token": replica.TOKEN},
+            raise_error=False,
+        )
+        public.stop()
+        self.assertEqual(response.code, 404)
+
+        # Everything else is still served next to it
+        response = await self.http_client.fetch(self.get_url("/v0/list"))
+        self.assertEqual(response.code, 200)
+
+    @gen_test
+    async def test_changes(self):
+        epoch = str(os.getpid())
+        revision = sessions.generation
+
+        added = sessions.add_entry(self.generate_session(), "8.8.8.8")
+        removed = sessions.add_entry(self.generate_session(), "8.8.8.8")
+        sessions.update_entry(added, player_count=3)
+        sessions.remove_entry(removed)
+
+        (
+            owner_epoch,
+            owner_revision,
+            changes,
+            records,
+            reset,
+            _,
+        ) = await self.replicate(revision, epoch)
+
+        self.assertEqual(owner_epoch, epoch)
+        self.assertEqual(owner_revision, sessions.generation)
+        self.assertFalse(reset)
+        self.assertEqual(
+            [change[3] for change in changes], ["add", "add", "update", "remove"]
+        )
+        self.assertEqual(records, {added: sessions.get_record(added), removed: None})
+
+        # Nothing new
+        _, _, changes, records, reset, _ = await self.replicate(owner_revision, epoch)
+        self.assertEqual((changes, records, reset), ([], {}, False))
+
+        # Replicas of another owner need all sessions
+        _, _, changes, records, reset, _ = await self.replicate(owner_revision, "0.0")
+        self.assertTrue(reset)
+        self.assertEqual(set(records), set(sessions.get_all()))
+
+        sessions.remove_entry(added)
+
+    @gen_test
+    async def test_up_to_date(self):
+        replica.owner_epoch = str(os.getpid())
+        revision = sessions.generation
+
+        await replica._replicate(self.get_url(""))
+
+        self.assertEqual(sessions.generation, revision)
+
+
+class ProxyTest(NetPlayIndexTest):
+    """Tests for the app of reader processes"""
+
+    def setUp(self):
+        super().setUp()
+        sock, port = tornado.testing.bind_unused_port()
+        self.reader_port = port
+        self.reader = tornado.httpserver.HTTPServer(
+            netplay_index.make_app(self.get_url(""))
+        )
+        self.reader.add_sockets([sock])
+
+    def tearDown(self):
+        self.reader.stop()
+        super().tearDown()
+
+    def get_reader_url(self, path):
+        return "http://127.0.0.1:{}{}".format(self.reader_port, path)
+
+    @gen_test
+    async def test_forward(self):
+        response = await self.http_client.fetch(
+            self.get_reader_url(
+                "/v0/session/add?name=Proxied&region=EU&game=Some+Game&server_id=a"
+                "&port=2626&player_count=1&in_game=0&password=0&method=direct"
+                "&version=5.0-666"
+            ),
+            headers={"X-Real-IP": "4.4.4.4"},
+        )
+        body = json.loads(response.body)
+        self.assertEqual(body["status"], "OK")
+        self.assertTrue(response.headers["Content-Type"].startswith("application/json"))
+
+        # Added by the owner, with the client's address
+        session = sessions.get_entry(body["secret"])
+        self.assertEqual(session["name"], "Proxied")
+        self.assertEqual(session.host, "4.4.4.4")
+
+        sessions.remove_entry(body["secret"])
+
+        response = await self.http_client.fetch(
+            self.get_reader_url("/"), follow_redirects=False, raise_error=False
+        )
+        self.assertEqual(response.code, 302)
+        self.assertEqual(response.headers["Location"], "https://dolphin-emu.org")
+
+        response = await self.http_client.fetch(
+            self.get_reader_url("/replicate?since=0&epoch=0"),
+            headers={"X-Replication-Token": replica.TOKEN},
+            raise_error=False,
+        )
+        self.assertEqual(response.code, 404)
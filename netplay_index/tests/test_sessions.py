@@ -0,0 +1,113 @@
+"""Tests for the session store"""
+
+import time
+from unittest import TestCase
+
+import netplay_index.sessions as sessions
+
+
+def _generate_session(**fields):
+    session = {
+        "name": "My Server",
+        "region": "EU",
+        "method": "traversal",
+        "password": False,
+        "in_game": True,
+        "port": 2626,
+        "server_id": "test.id",
+        "player_count": 2,
+        "game": "Some Game",
+        "version": "5.0-666",
+        "timestamp": time.time() + 100,
+    }
+    session.update(fields)
+    return session
+
+
+class SessionRecordTest(TestCase):
+    def test_views(self):
+        secret = sessions.add_entry(_generate_session(), "2001:DB8::1")
+        session = sessions.get_entry(secret)
+
+        self.assertEqual(session["name"], "My Server")
+        self.assertEqual(session.to_dict(), dict(session))
+        self.assertEqual(session.to_dict()["id"], session.id)
+
+        self.assertEqual(sessions.hosts()[secret], "2001:db8::1")
+        self.assertEqual(sessions.regions()[secret], None)
+        self.assertIn(secret, sessions.get_host_sessions("2001:db8::1"))
+
+        sessions.remove_entry(secret)
+
+        self.assertNotIn(secret, sessions.hosts())
+        self.assertEqual(sessions.get_host_session_count("2001:db8::1"), 0)
+
+    def test_interning(self):
+        version = "".join(["5.0-", "4242"])
+        first = sessions.add_entry(_generate_session(version=version), "8.8.8.8")
+        second = sessions.add_entry(
+            _generate_session(version="".join(["5.0-", "4242"])), "8.8.8.8"
+        )
+
+        self.assertIs(
+            sessions.get_entry(first).version, sessions.get_entry(second).version
+        )
+        self.assertIs(
+            sessions.get_entry(first).country, sessions.get_entry(second).country
+        )
+        self.assertEqual(sessions.INTERNED[version][1], 2)
+
+        sessions.update_entry(second, version="5.0-4243")
+        self.assertEqual(sessions.INTERNED[version][1], 1)
+
+        sessions.remove_entry(first)
+        sessions.remove_entry(second)
+
+        self.assertNotIn(version, sessions.INTERNED)
+        self.assertNotIn("5.0-4243", sessions.INTERNED)
+
+
+class ReplicateTest(TestCase):
+    def test_replicate(self):
+        secret = sessions.add_entry(_generate_session(region="OC"), "8.8.8.8")
+        record = sessions.get_record(secret)
+        session_id = record[0][0]
+        sessions.remove_entry(secret)
+
+        events = []
+        listener = lambda *args: events.append(args)
+        sessions.add_listener(listener)
+
+        revision = sessions.generation + 1
+        queued = len(sessions.EXPIRY_QUEUE)
+        change = (revision, secret, session_id, "add")
+        sessions.replicate(revision, [change], {secret: record})
+
+        self.assertEqual(sessions.generation, revision)
+        self.assertEqual(sessions.CHANGES[-1], change)
+        self.assertEqual(sessions.get_record(secret), record)
+        self.assertIn(secret, sessions.find({"region": "OC"}))
+        self.assertEqual(events, [(secret, session_id, "add")])
+
+        values = dict(zip(sessions.FIELDS, record[0]))
+        values["player_count"] = 4
+        values["timestamp"] += 1
+        updated = (tuple(values.values()), record[1], record[2])
+        sessions.replicate(
+            revision + 1,
+            [(revision + 1, secret, session_id, "update")],
+            {secret: updated},
+        )
+        self.assertEqual(sessions.get_entry(secret)["player_count"], 4)
+        self.assertEqual(sessions.sort_key("player_count", secret), (4, session_id))
+
+        # Only the process owning the sessions expires them
+        self.assertEqual(len(sessions.EXPIRY_QUEUE), queued)
+
+        sessions.replicate(
+            revision + 2, [(revision + 2, secret, session_id, "remove")], {secret: None}
+        )
+        self.assertIsNone(sessions.get_entry(secret))
+        self.assertNotIn(secret, sessions.find({"region": "OC"}))
+
+        sessions.remove_listener(listener)
@@ -0,0 +1,75 @@
+"""Checks whether sessions survive restarts"""
+
+import os
+import tempfile
+import time
+
+from tornado.testing import AsyncTestCase, gen_test
+
+import netplay_index.sessions as sessions
+import netplay_index.snapshot as snapshot
+from netplay_index.tests.test_sessions import _generate_session
+
+
+class SnapshotTest(AsyncTestCase):
+    def setUp(self):
+        super().setUp()
+        self.directory = tempfile.TemporaryDirectory()
+        self.path = os.path.join(self.directory.name, "sessions.snapshot")
+
+    def tearDown(self):
+        self.directory.cleanup()
+        super().tearDown()
+
+    def test_restore(self):
+        fresh = sessions.add_entry(_generate_session(), "2001:db8::1")
+        expired = sessions.add_entry(
+            _generate_session(timestamp=time.time() - 100), "8.8.8.8"
+        )
+        record = sessions.get_record(fresh)
+        session_count = sessions.total_session_count
+        revision = sessions.generation
+
+        snapshot.save(self.path)
+
+        # Pretend we restarted
+        sessions.remove_entry(fresh)
+        sessions.remove_entry(expired)
+
+        self.assertEqual(snapshot.load(self.path), 1)
+        self.assertEqual(sessions.get_record(fresh), record)
+        self.assertEqual(sessions.hosts()[fresh], "2001:db8::1")
+        self.assertIsNone(sessions.get_entry(expired))
+        self.assertEqual(sessions.total_session_count, session_count)
+        self.assertIn(fresh, sessions.find({"region": "EU"}))
+
+        # Clients don't know which sessions were dropped, or which changes
+        # were lost, and get a full list
+        self.assertIsNone(sessions.changes_since(revision))
+        self.assertIsNone(sessions.changes_since(revision + 1))
+
+        sessions.remove_entry(fresh)
+
+    def test_bad_file(self):
+        self.assertEqual(snapshot.load(self.path), 0)
+
+        with open(self.path, "wb") as snapshot_file:
+            snapshot_file.write(b"not a snapshot")
+        self.assertEqual(snapshot.load(self.path), 0)
+
+        with open(self.path, "wb") as snapshot_file:
+            snapshot_file.write(snapshot.MAGIC + b"garbage")
+        self.assertEqual(snapshot.load(self.path), 0)
+
+    @gen_test
+    async def test_save_in_background(self):
+        secret = sessions.add_entry(_generate_session(), "8.8.8.8")
+
+        await snapshot.save_in_background(self.path)
+        self.assertFalse(snapshot.saving)
+
+        sessions.remove_entry(secret)
+        self.assertEqual(snapshot.load(self.path), 1)
+        self.assertIsNotNone(sessions.get_entry(secret))
+
+        sessions.remove_entry(secret)
@@ -0,0 +1,95 @@
+"""Tests for utility functions"""
+
+from unittest import TestCase
+
+import prometheus_client
+
+import netplay_index.util as util
+
+
+class LRUCacheTest(TestCase):
+    def runTest(self):
+        cache = util.LRUCache(2)
+
+        cache.put("a", 1)
+        cache.put("b", 2)
+        self.assertEqual(cache.get("a"), 1)
+
+        # "b" is now the least recently used entry
+        cache.put("c", 3)
+
+        self.assertIn("a", cache)
+        self.assertNotIn("b", cache)
+        self.assertEqual(cache.get("b", 0), 0)
+        self.assertEqual(len(cache), 2)
+
+
+class TokenBucketsTest(TestCase):
+    def runTest(self):
+        buckets = util.TokenBuckets(2)
+
+        for _ in range(3):
+            self.assertEqual(buckets.take("a", 1, 3, now=0), 0)
+
+        # Empty, one token per second
+        self.assertEqual(buckets.take("a", 1, 3, now=0), 1)
+        self.assertAlmostEqual(buckets.take("a", 1, 3, now=0.5), 0.5)
+        self.assertEqual(buckets.take("a", 1, 3, now=1), 0)
+
+        # Refunded tokens can be taken again
+        buckets.refund("a", 3)
+        self.assertEqual(buckets.take("a", 1, 3, now=1), 0)
+
+        # Buckets are never fuller than burst
+        self.assertEqual(buckets.take("b", 1, 1, now=0), 0)
+        self.assertEqual(buckets.take("b", 1, 1, now=100), 0)
+        self.assertEqual(buckets.take("b", 1, 1, now=100), 1)
+
+        # The least recently used bucket is forgotten
+        buckets.take("c", 1, 1, now=0)
+        self.assertEqual(len(buckets), 2)
+        self.assertEqual(buckets.take("a", 1, 3, now=1), 0)
+
+
+class RateLimitKeyTest(TestCase):
+    def runTest(self):
+        self.assertEqual(util.get_rate_limit_key("1.2.3.4"), "1.2.3.4")
+        self.assertEqual(
+            util.get_rate_limit_key("2001:db8:1:2::1"),
+            util.get_rate_limit_key("2001:db8:1:2:abcd::1"),
+        )
+        self.assertNotEqual(
+            util.get_rate_limit_key("2001:db8:1:2::1"),
+            util.get_rate_limit_key("2001:db8:1:3::1"),
+        )
+        self.assertEqual(util.get_rate_limit_key("::ffff:1.2.3.4"), "1.2.3.4")
+        self.assertEqual(util.get_rate_limit_key("not:an:ip"), "not:an:ip")
+
+
+class GeoIPTest(TestCase):
+    def test_cache(self):
+        util.GEOIP_CACHE.clear()
+
+        self.assertEqual(util.get_ip_region("8.8.8.8"), "us")
+        self.assertIn("8.8.8.8", util.GEOIP_CACHE)
+
+        hits = prometheus_client.REGISTRY.get_sample_value(
+            "geoip_cache_hit_count_total"
+        )
+        self.assertEqual(util.get_ip_region("8.8.8.8"), "us")
+        self.assertEqual(
+            prometheus_client.REGISTRY.get_sample_value("geoip_cache_hit_count_total"),
+            hits + 1,
+        )
+
+    def test_reload(self):
+        reader = util._get_geoip_reader()
+        self.assertIs(util._get_geoip_reader(), reader)
+
+        # Pretend the database file changed since it was opened
+        util.GEOIP_LAST_CHECK = 0
+        util.GEOIP_MTIME = None
+        util.GEOIP_CACHE.put("8.8.8.8", "??")
+
+        self.assertIsNot(util._get_geoip_reader(), reader)
+        self.assertEqual(util.get_ip_region("8.8.8.8"), "us")
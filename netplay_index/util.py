@@ -1,20 +1,160 @@
 """Utility class"""
 
+from collections import OrderedDict
+import ipaddress
+import os
+import time
+
 import geoip2.database
 import random
 
+import netplay_index.metrics as metrics
 import netplay_index.settings as settings
 
 SECRET_KEY_CHARACTERS = "ABCDEFGHIJKLMNOPQRSTUVWXYZabcdefghijklmnopqrstuvwxyz0123456789"
 SECRET_KEY_LENGTH = 10
 
 
+class LRUCache:
+    """Mapping holding up to max_size entries, dropping the least recently used"""
+
+    def __init__(self, max_size):
+        self.max_size = max_size
+        self.entries = OrderedDict()
+
+    def get(self, key, default=None):
+        """Get an entry and mark it as recently used"""
+        if key not in self.entries:
+            return default
+
+        self.entries.move_to_end(key)
+        return self.entries[key]
+
+    def put(self, key, value):
+        """Add or replace an entry, evicting the oldest one if full"""
+        self.entries[key] = value
+        self.entries.move_to_end(key)
+
+        if len(self.entries) > self.max_size:
+            self.entries.popitem(last=False)
+
+    def clear(self):
+        """Remove all entries"""
+        self.entries.clear()
+
+    def __contains__(self, key):
+        return key in self.entries
+
+    def __len__(self):
+        return len(self.entries)
+
+
+class TokenBuckets:
+    """Token buckets by key, forgetting the least recently used ones
+
+    A forgotten bucket is as good as full, so only keys idle long enough to
+    have refilled should be dropped: size accordingly."""
+
+    def __init__(self, max_size):
+        self.buckets = LRUCache(max_size)
+
+    def take(self, key, rate, burst, now=None):
+        """Take a token from the bucket of key, refilled at rate per second
+
+        Returns 0 if there was one, otherwise how many seconds until there is."""
+        if now is None:
+            now = time.monotonic()
+
+        bucket = self.buckets.get(key)
+
+        if bucket is None:
+            self.buckets.put(key, [burst - 1, now])
+            return 0
+
+        tokens = min(burst, bucket[0] + (now - bucket[1]) * rate)
+        bucket[1] = now
+
+        if tokens < 1:
+            bucket[0] = tokens
+            return (1 - tokens) / rate
+
+        bucket[0] = tokens - 1
+        return 0
+
+    def refund(self, key, burst):
+        """Put back a token taken from the bucket of key"""
+        bucket = self.buckets.get(key)
+
+        if bucket is not None:
+            bucket[0] = min(burst, bucket[0] + 1)
+
+    def clear(self):
+        """Refill all buckets"""
+        self.buckets.clear()
+
+    def __len__(self):
+        return len(self.buckets)
+
+
+GEOIP_READER = None
+GEOIP_MTIME = None
+GEOIP_LAST_CHECK = 0
+
+# Recent lookups, by IP
+GEOIP_CACHE = LRUCache(settings.GEOIP_CACHE_SIZE)
+
+
+def _get_geoip_reader():
+    """Return the GeoIP reader, reopening it if the database file changed"""
+
+    # pylint: disable=W0603
+    global GEOIP_READER, GEOIP_MTIME, GEOIP_LAST_CHECK
+
+    now = time.monotonic()
+
+    if (
+        GEOIP_READER is not None
+        and now - GEOIP_LAST_CHECK < settings.GEOIP_RELOAD_CHECK_INTERVAL
+    ):
+        return GEOIP_READER
+
+    GEOIP_LAST_CHECK = now
+    mtime = os.stat(settings.GEOIP_DATABASE_PATH).st_mtime
+
+    if GEOIP_READER is None or mtime != GEOIP_MTIME:
+        if GEOIP_READER is not None:
+            GEOIP_READER.close()
+
+        GEOIP_READER = geoip2.database.Reader(settings.GEOIP_DATABASE_PATH)
+        GEOIP_MTIME = mtime
+        GEOIP_CACHE.clear()
+
+    return GEOIP_READER
+
+
+@metrics.GEOIP_LOOKUP_DURATION.time()
 def get_ip_region(ip):
-    reader = geoip2.database.Reader(settings.GEOIP_DATABASE_PATH)
+    """Get the lowercase country code of an IP, None if unknown"""
+    reader = _get_geoip_reader()
+
+    if ip in GEOIP_CACHE:
+        metrics.GEOIP_CACHE_HIT_COUNT.inc()
+        return GEOIP_CACHE.get(ip)
+
+    metrics.GEOIP_CACHE_MISS_COUNT.inc()
+
     try:
-        return reader.country(ip).country.iso_code.lower()
+        region = reader.country(ip).country.iso_code
     except geoip2.errors.AddressNotFoundError:
-        return None
+        region = None
+
+    # Some networks are only known by continent
+    if region is not None:
+        region = region.lower()
+
+    GEOIP_CACHE.put(ip, region)
+
+    return region
 
 
 def generate_secret():
@@ -45,3 +185,27 @@ def get_ip(handler):
             return real_ip
 
     return handler.request.remote_ip
+
+
+def get_rate_limit_key(ip):
+    """Get what requests from an IP share rate limits by
+
+    IPv6 hosts usually get a whole prefix to pick addresses from, so they are
+    limited by that prefix instead."""
+    if ":" not in ip:
+        return ip
+
+    try:
+        address = ipaddress.ip_address(ip)
+    except ValueError:
+        return ip
+
+    # IPv4 clients of dual-stack sockets
+    if address.ipv4_mapped is not None:
+        return str(address.ipv4_mapped)
+
+    return str(
+        ipaddress.ip_network(
+            "{}/{}".format(address, settings.RATE_LIMIT_IPV6_PREFIX), strict=False
+        )
+    )